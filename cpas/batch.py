@@ -0,0 +1,237 @@
+# This file is part of cpas.
+#
+# cpas is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cpas is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cpas.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2020 cpas team
+
+import logging
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from . import compute
+from . import least_cost_path
+from .budget import MemoryBudget, parse_memory, format_memory
+from .cli import parse_args
+from .config import CpasConfig
+
+STAGES = ['compute', 'path']
+
+
+def estimate_memory(cfg, stages):
+    """estimate the memory needed by a region
+
+    Parameters
+    ----------
+    cfg: cpas configuration of the region
+    stages: list of stages to run
+
+    Returns
+    -------
+    number of bytes
+    """
+
+    # the region is limited by its own memory limit if it has one
+    if cfg.memory_limit is not None:
+        return parse_memory(cfg.memory_limit)
+
+    budget = MemoryBudget(cfg.landcover)
+    estimate = 0
+    if 'compute' in stages:
+        fixed, per_row = budget.estimate_compute(
+            memory_mapped=cfg.scratch is not None, nprocs=cfg.nprocs)
+        estimate = fixed + per_row * min(1024, budget.height)
+    if 'path' in stages:
+        estimate = max(estimate, budget.estimate_path(
+            k_nearest=cfg.k_nearest, lean_memory=cfg.lean_memory,
+            coarsen=cfg.coarsen))
+    return estimate
+
+
+def run_region(fname, stages, resume=False):
+    """run the pipeline for a single region
+
+    Parameters
+    ----------
+    fname: name of configuration file of region
+    stages: list of stages to run
+    resume: whether to resume from the last completed stage
+
+    Returns
+    -------
+    time taken in seconds
+    """
+
+    start = time.time()
+    cfg = CpasConfig()
+    cfg.read(fname)
+
+    if 'compute' in stages:
+        logging.info(f'{fname}: compute cost surfaces')
+        compute.run(cfg, resume=resume)
+    if 'path' in stages:
+        logging.info(f'{fname}: compute access to services')
+        least_cost_path.run(cfg, resume=resume)
+
+    return time.time() - start
+
+
+def prepare_regions(fnames, stages, memory_limit=None):
+    """read configurations and estimate the memory needed by each region
+
+    Parameters
+    ----------
+    fnames: list of names of configuration files
+    stages: list of stages to run
+    memory_limit: total memory available in bytes
+
+    Returns
+    -------
+    list of tuples of configuration file and estimated memory and
+    dictionary of regions which cannot be run
+    """
+
+    regions = []
+    failed = {}
+    for fname in fnames:
+        try:
+            cfg = CpasConfig()
+            cfg.read(fname)
+            estimate = estimate_memory(cfg, stages)
+        except Exception as e:
+            failed[fname] = ('failed', 0., str(e))
+            continue
+        if memory_limit is not None and estimate > memory_limit:
+            msg = f'needs an estimated {format_memory(estimate)} of ' \
+                f'memory but the memory limit is {format_memory(memory_limit)}'
+            failed[fname] = ('failed', 0., msg)
+            continue
+        regions.append((fname, estimate))
+    return regions, failed
+
+
+def _start_regions(executor, pending, running, stages, nprocs=1,
+                   memory_limit=None, resume=False):
+    """start as many pending regions as fit into the memory limit"""
+    used = sum(estimate for fname, estimate in running.values())
+    for region in list(pending):
+        if len(running) >= nprocs:
+            break
+        if memory_limit is not None and used + region[1] > memory_limit:
+            continue
+        future = executor.submit(run_region, region[0], stages,
+                                 resume=resume)
+        running[future] = region
+        used += region[1]
+        pending.remove(region)
+
+
+def _result(future):
+    """the status, time taken and error message of a finished region and
+    whether the pool of processes broke"""
+    try:
+        return ('ok', future.result(), ''), False
+    except BrokenProcessPool:
+        msg = 'a process of the pool died, eg it was killed for running ' \
+            'out of memory'
+        return ('failed', 0., msg), True
+    except Exception as e:
+        return ('failed', 0., str(e)), False
+
+
+def run_batch(fnames, stages, nprocs=1, memory_limit=None, resume=False):
+    """run the pipeline for many regions
+
+    The regions are run in parallel on a pool of processes such that the
+    sum of their estimated memory needs does not exceed the memory limit.
+    A process is reused for several regions which allows the regions to
+    share the inputs cached by cpas.inputs. A failing region does not
+    affect the others. If a process dies, eg killed for running out of
+    memory, the regions running in the pool at the time fail and the
+    remaining regions are run in a new pool.
+
+    Parameters
+    ----------
+    fnames: list of names of configuration files
+    stages: list of stages to run
+    nprocs: maximum number of regions processed at the same time
+    memory_limit: total memory available, see parse_memory
+    resume: whether to resume regions from their last completed stage
+
+    Returns
+    -------
+    dictionary mapping configuration file to a tuple of status, time
+    taken and error message
+    """
+
+    if memory_limit is not None:
+        memory_limit = parse_memory(memory_limit)
+
+    pending, results = prepare_regions(fnames, stages,
+                                       memory_limit=memory_limit)
+
+    running = {}
+    broken = False
+    executor = ProcessPoolExecutor(max_workers=nprocs)
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            if not broken:
+                _start_regions(executor, pending, running, stages,
+                               nprocs=nprocs, memory_limit=memory_limit,
+                               resume=resume)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                fname, estimate = running.pop(future)
+                results[fname], died = _result(future)
+                broken = broken or died
+                logging.info(f'{fname}: {results[fname][0]}')
+
+            # a broken pool cannot run any more regions, replace it once
+            # the regions it was running have failed
+            if broken and len(running) == 0:
+                executor.shutdown()
+                executor = ProcessPoolExecutor(max_workers=nprocs)
+                broken = False
+    finally:
+        executor.shutdown()
+
+    return results
+
+
+def main(args=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if args is None:
+        args = parse_args('batch')
+
+    stages = STAGES if args.stage is None else args.stage
+
+    results = run_batch(args.config, stages, nprocs=args.nprocs,
+                        memory_limit=args.memory_limit, resume=args.resume)
+
+    failed = 0
+    for fname in args.config:
+        status, elapsed, msg = results[fname]
+        print(f'{status:6s} {elapsed:8.1f}s {fname} {msg}')
+        if status != 'ok':
+            failed += 1
+    print(f'{len(args.config) - failed} regions succeeded, {failed} failed')
+
+    if failed > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
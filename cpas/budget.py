@@ -0,0 +1,240 @@
+# This file is part of cpas.
+#
+# cpas is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cpas is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cpas.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2020 cpas team
+
+import logging
+import re
+import numpy
+import rasterio
+
+# rough estimates of the number of bytes needed per grid cell
+# resident intermediate arrays of compute (speed surfaces, slope impact,
+# combined speed and cost surfaces) unless they are memory mapped
+COMPUTE_RESIDENT = 20
+# temporary arrays needed per cell of a block of rows when computing the
+# slope impact, including the reprojected DEM
+COMPUTE_SLOPE = 52
+# temporary arrays needed when rasterizing the roads of the whole grid
+COMPUTE_ROADS = 24
+# temporary arrays per cell of a block of rows
+COMPUTE_BLOCK = 24
+# the least cost path computation: cost surface, its filled copy, the
+# internal arrays of the MCP algorithm and the resulting costs of both
+# passes
+PATH = 112
+# each additional label of the k nearest services search, measured: its
+# float64 cost and int32 source during the search and the costs of both
+# passes and of the merged result
+PATH_LABEL = 40
+# the least cost path computation avoiding copies: cost surface, the
+# internal arrays of the MCP algorithm on the 2D grid and the float32 costs
+# of a single pass
+PATH_LEAN = 88
+# each additional label in the lean memory mode, measured: its float64 cost
+# and int32 source during the search and the float32 costs
+PATH_LABEL_LEAN = 16
+# the costs computed at multiple resolutions, measured: the cost surface
+# at the native resolution, plus for each label the float32 costs of both
+# passes, their merged result and the copy made when writing it. The
+# searches on the coarse grid and on the refined region are estimated like
+# that on the whole grid
+MULTIRES = 44
+MULTIRES_LABEL = 24
+
+UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+
+def parse_memory(value):
+    """convert a memory size to bytes
+
+    Parameters
+    ----------
+    value: memory size, either a number of bytes or a number followed by
+           one of the units K, M, G or T, eg 16G or 1.5T
+
+    Returns
+    -------
+    number of bytes
+    """
+
+    m = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]?)B?\s*', str(value).upper())
+    if m is None:
+        msg = f'cannot parse memory size {value}'
+        raise RuntimeError(msg)
+    return int(float(m.group(1)) * UNITS[m.group(2)])
+
+
+def format_memory(nbytes):
+    """format number of bytes in human readable form"""
+    for unit in ['T', 'G', 'M', 'K']:
+        if nbytes >= UNITS[unit]:
+            return f'{nbytes / UNITS[unit]:.1f}{unit}'
+    return f'{nbytes}B'
+
+
+class MemoryBudget:
+    """plan chunk sizes given a memory limit
+
+    The grid shape and data type are read from the raster header so that
+    the plan can be made before any data is loaded.
+
+    Parameters
+    ----------
+    fname: name of raster defining the grid, usually the landcover
+    limit: memory limit, see parse_memory. When None there is no limit
+    """
+
+    def __init__(self, fname, limit=None):
+        with rasterio.open(fname) as ds:
+            self.height = ds.height
+            self.width = ds.width
+            dtype = numpy.dtype(ds.dtypes[0])
+        # masked rasters are converted to floating point
+        self.itemsize = numpy.promote_types(dtype, numpy.float32).itemsize
+        self.limit = None
+        if limit is not None:
+            self.limit = parse_memory(limit)
+
+    @property
+    def cells(self):
+        return self.height * self.width
+
+    def _check(self, estimate, task):
+        if self.limit is not None and estimate > self.limit:
+            msg = f'{task} of {self.height}x{self.width} grid needs an ' \
+                f'estimated {format_memory(estimate)} of memory but the ' \
+                f'memory limit is {format_memory(self.limit)}'
+            raise RuntimeError(msg)
+        logging.info(f'{task} needs an estimated {format_memory(estimate)} '
+                     'of memory')
+
+    def _rows(self, available, bytes_per_cell):
+        """number of rows fitting into available memory"""
+        rows = available // (bytes_per_cell * self.width)
+        return int(max(1, min(rows, self.height)))
+
+    def estimate_compute(self, memory_mapped=False, nprocs=1):
+        """estimate memory needed by the cost surface computation
+
+        Parameters
+        ----------
+        memory_mapped: whether the intermediate arrays are memory mapped
+        nprocs: number of processes used for rasterizing roads
+
+        Returns
+        -------
+        tuple of number of bytes needed independent of the block sizes and
+        number of bytes needed per row of a block
+        """
+
+        per_cell = 0
+        if not memory_mapped:
+            per_cell += COMPUTE_RESIDENT
+        if nprocs > 1:
+            # the mask of the cells without roads
+            per_cell += 1
+        else:
+            per_cell += COMPUTE_ROADS
+        per_row = (self._block_cell() + COMPUTE_ROADS * nprocs) * self.width
+        return per_cell * self.cells, per_row
+
+    def _block_cell(self):
+        """bytes needed per cell of a block of rows: the landcover read for
+        the block, the temporary arrays and those of the slope impact"""
+        return self.itemsize + COMPUTE_BLOCK + COMPUTE_SLOPE
+
+    def _path_cell(self, k_nearest=1, lean_memory=False):
+        """bytes needed per cell by the least cost path search"""
+        if lean_memory:
+            return PATH_LEAN + PATH_LABEL_LEAN * (k_nearest - 1)
+        return PATH + PATH_LABEL * (k_nearest - 1)
+
+    def estimate_path(self, k_nearest=1, lean_memory=False, coarsen=1):
+        """estimate memory needed by the least cost path computation
+
+        Parameters
+        ----------
+        k_nearest: number of nearest services
+        lean_memory: whether the lean memory mode is used
+        coarsen: factor by which the grid is coarsened when computing the
+                 costs at multiple resolutions. The search on the refined
+                 region is not included as its size is only known after
+                 the coarse search, see plan_refine
+        """
+        if coarsen == 1:
+            return self._path_cell(k_nearest, lean_memory) * self.cells
+        coarse = -(-self.height // coarsen) * -(-self.width // coarsen)
+        return (MULTIRES + MULTIRES_LABEL * k_nearest) * self.cells + \
+            self._path_cell(k_nearest) * coarse
+
+    def plan_compute(self, memory_mapped=False, nprocs=1):
+        """plan the cost surface computation
+
+        Parameters
+        ----------
+        memory_mapped: whether the intermediate arrays are memory mapped
+        nprocs: number of processes used for rasterizing roads
+
+        Returns
+        -------
+        tuple of number of rows processed in a block and number of rows
+        of a road rasterization band
+        """
+
+        fixed, per_row = self.estimate_compute(memory_mapped=memory_mapped,
+                                               nprocs=nprocs)
+        # require at least one row per block and band
+        self._check(fixed + per_row, 'computing the cost surface')
+
+        if self.limit is None:
+            return 1024, None
+
+        available = self.limit - fixed
+        block_rows = self._rows(available, self._block_cell())
+        band_rows = None
+        if nprocs > 1:
+            band_rows = self._rows(available, COMPUTE_ROADS * nprocs)
+        return block_rows, band_rows
+
+    def plan_path(self, k_nearest=1, lean_memory=False, coarsen=1):
+        """check the least cost path computation fits into memory
+
+        The least cost path algorithm operates on the whole grid, or on the
+        coarse grid when the costs are computed at multiple resolutions.
+
+        Parameters
+        ----------
+        k_nearest: number of nearest services
+        lean_memory: whether the lean memory mode is used
+        coarsen: factor by which the grid is coarsened
+        """
+        self._check(self.estimate_path(k_nearest=k_nearest,
+                                       lean_memory=lean_memory,
+                                       coarsen=coarsen),
+                    'computing the least cost path')
+
+    def plan_refine(self, cells, k_nearest=1, coarsen=1):
+        """check refining the costs of a region fits into memory
+
+        Parameters
+        ----------
+        cells: number of cells of the refined region
+        k_nearest: number of nearest services
+        coarsen: factor by which the grid is coarsened
+        """
+        estimate = self.estimate_path(k_nearest=k_nearest, coarsen=coarsen)
+        self._check(estimate + self._path_cell(k_nearest) * cells,
+                    'refining the least cost path')
@@ -0,0 +1,79 @@
+# This file is part of cpas.
+#
+# cpas is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cpas is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cpas.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2020 cpas team
+
+import numpy
+import pandas
+from rasterio import windows
+
+
+def cell_centres(transform, width, height):
+    """compute the coordinates of the cell centres of a grid
+
+    Parameters
+    ----------
+    transform: affine transform of the grid
+    width: number of columns
+    height: number of rows
+
+    Returns
+    -------
+    tuple of pandas indices containing the x and y coordinates
+    """
+
+    x = transform.c + (numpy.arange(width) + 0.5) * transform.a
+    y = transform.f + (numpy.arange(height) + 0.5) * transform.e
+    return pandas.Index(x), pandas.Index(y)
+
+
+def nearest_cells(xs, ys, longs, lats):
+    """find the indices of the cells nearest to some locations
+
+    Parameters
+    ----------
+    xs: array of x coordinates of the locations
+    ys: array of y coordinates of the locations
+    longs: pandas index containing the x coordinates of the cell centres
+    lats: pandas index containing the y coordinates of the cell centres
+
+    Returns
+    -------
+    tuple of arrays containing the column and row indices
+    """
+
+    idx_i = longs.get_indexer(numpy.asarray(xs), method='nearest')
+    idx_j = lats.get_indexer(numpy.asarray(ys), method='nearest')
+    return idx_i, idx_j
+
+
+def tile_windows(width, height, tile_size):
+    """split a grid into tiles
+
+    Parameters
+    ----------
+    width: number of columns
+    height: number of rows
+    tile_size: number of rows and columns of a tile
+
+    Returns
+    -------
+    generator of rasterio windows
+    """
+
+    for row in range(0, height, tile_size):
+        for col in range(0, width, tile_size):
+            yield windows.Window(col, row, min(tile_size, width - col),
+                                 min(tile_size, height - row))
@@ -0,0 +1,179 @@
+# This file is part of cpas.
+#
+# cpas is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cpas is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cpas.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2020 cpas team
+
+import csv
+import os
+import sys
+from pathlib import Path
+import rasterio
+from configobj import ConfigObjError
+from .cli import parse_args
+from .config import CpasConfig
+from .vector import ROAD_TAG, column_names
+
+
+def check_raster(fname):
+    """check a raster can be opened reading only its header
+
+    Parameters
+    ----------
+    fname: name of raster file
+
+    Returns
+    -------
+    tuple of list of problems and the header, None if it cannot be read
+    """
+
+    try:
+        with rasterio.open(fname) as ds:
+            header = {'crs': ds.crs, 'bounds': ds.bounds,
+                      'shape': ds.shape, 'dtype': ds.dtypes[0]}
+    except rasterio.errors.RasterioIOError as e:
+        return [f'cannot open raster {fname}: {e}'], None
+    problems = []
+    if header['crs'] is None:
+        problems.append(f'raster {fname} has no CRS')
+    return problems, header
+
+
+def check_columns(fname, columns, kind):
+    """check a table or vector layer contains some columns
+
+    Parameters
+    ----------
+    fname: name of csv file or vector layer
+    columns: list of column names
+    kind: either 'csv' or 'vector'
+
+    Returns
+    -------
+    list of problems
+    """
+
+    try:
+        if kind == 'csv':
+            with open(fname, newline='') as f:
+                names = next(csv.reader(f), [])
+        else:
+            names = column_names(fname)
+    except (OSError, ValueError) as e:
+        return [f'cannot read {fname}: {e}']
+    return [f'{fname} has no column {c}' for c in columns if c not in names]
+
+
+def check_outputbase(cfg):
+    """check the output directory can be created and written to"""
+    path = Path(cfg.cfg['outputs']['outputbase']).absolute()
+    # the nearest existing directory must be writable
+    while not path.exists():
+        path = path.parent
+    if not path.is_dir() or not os.access(path, os.W_OK):
+        return [f'cannot write to output directory {path}']
+    return []
+
+
+def check_inputs(cfg):
+    """check the input files exist and have the expected structure
+
+    Parameters
+    ----------
+    cfg: cpas configuration
+
+    Returns
+    -------
+    tuple of list of problems and list of notes, the notes do not stop a
+    run
+    """
+
+    problems = []
+    notes = []
+    inputs = [cfg.landcover, cfg.landcover_ws, cfg.roads, cfg.roads_ws,
+              cfg.dem, cfg.destinations]
+    missing = [f for f in inputs if not Path(f).exists()]
+    problems += [f'no such input file {f}' for f in missing]
+
+    headers = {}
+    for name in ['landcover', 'dem']:
+        fname = getattr(cfg, name)
+        if fname not in missing:
+            p, headers[name] = check_raster(fname)
+            problems += p
+    if headers.get('landcover') is not None and \
+       headers.get('dem') is not None:
+        if headers['landcover']['crs'] != headers['dem']['crs']:
+            # the DEM is reprojected onto the landcover grid
+            notes.append('landcover and DEM use different CRSs, the DEM '
+                         'is reprojected')
+
+    columns = [
+        (cfg.landcover_ws, [cfg.landcover_cfg['landcover_type_column'],
+                            cfg.landcover_cfg['speed_column']], 'csv'),
+        (cfg.roads_ws, [cfg.roads_cfg['road_type_column'],
+                        cfg.roads_cfg['speed_column']], 'csv'),
+        (cfg.roads, [ROAD_TAG], 'vector'),
+        (cfg.destinations, [], 'vector')]
+    for fname, names, kind in columns:
+        if fname not in missing:
+            problems += check_columns(fname, names, kind)
+    return problems, notes
+
+
+def validate(fname):
+    """check a configuration file and the inputs it refers to
+
+    Only file headers are read.
+
+    Parameters
+    ----------
+    fname: name of configuration file
+
+    Returns
+    -------
+    tuple of list of problems and list of notes
+    """
+
+    cfg = CpasConfig()
+    try:
+        cfg.read(fname)
+    except (RuntimeError, ConfigObjError) as e:
+        return [str(e)], []
+    problems, notes = check_inputs(cfg)
+    return problems + check_outputbase(cfg), notes
+
+
+def main(args=None):
+    if args is None:
+        args = parse_args('validate')
+
+    failed = 0
+    for fname in args.config:
+        problems, notes = validate(fname)
+        for n in notes:
+            print(f'{fname}: note: {n}')
+        for p in problems:
+            print(f'{fname}: {p}')
+        if len(problems) > 0:
+            failed += 1
+        else:
+            print(f'{fname}: ok')
+
+    if failed > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
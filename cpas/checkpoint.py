@@ -0,0 +1,181 @@
+# This file is part of cpas.
+#
+# cpas is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cpas is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cpas.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2020 cpas team
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import rasterio
+from configobj import ConfigObj
+from .fingerprint import fingerprint
+from .scratch import write_raster
+
+# configuration options which do not change the results
+RUNTIME_OPTIONS = ['nprocs', 'scratch', 'memory_limit', 'checkpoints']
+
+
+def run_key(cfg, inputs):
+    """compute a key identifying the inputs and configuration of a run
+
+    Parameters
+    ----------
+    cfg: cpas configuration
+    inputs: list of input files
+
+    Returns
+    -------
+    hex digest string
+    """
+
+    settings = cfg.cfg.dict()
+    for k in RUNTIME_OPTIONS:
+        settings['outputs'].pop(k, None)
+
+    h = hashlib.sha256()
+    h.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    for fname in inputs:
+        h.update(fingerprint(fname).encode())
+    return h.hexdigest()
+
+
+def _sync(fname):
+    """flush file to disk"""
+    fd = os.open(fname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Checkpoint:
+    """record the stages of a run that have completed
+
+    The completed stages are stored in a manifest together with a key
+    identifying the inputs and configuration. Intermediate results are
+    stored as GeoTIFFs next to the manifest. All files are written to a
+    temporary name first and then moved into place so that a run killed
+    while writing a checkpoint leaves the previous checkpoint intact.
+
+    Parameters
+    ----------
+    directory: directory holding the checkpoints
+    name: name of the program, used for the manifest
+    key: key identifying inputs and configuration, see run_key
+    resume: when set continue from the completed stages. Otherwise any
+            existing checkpoint is discarded
+    """
+
+    def __init__(self, directory, name, key, resume=False):
+        self._directory = Path(directory)
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._name = name
+        self._manifest = ConfigObj()
+        self._manifest.filename = str(self._directory / f'{name}.cfg')
+
+        if resume:
+            if Path(self._manifest.filename).is_file():
+                self._manifest.reload()
+                if self._manifest.get('key') != key:
+                    msg = 'inputs or configuration have changed since ' \
+                        f'checkpoint {self._manifest.filename} was written'
+                    raise RuntimeError(msg)
+                logging.info('resuming after stages ' + ', '.join(
+                    self._manifest.get('stages', {}).keys()))
+            else:
+                logging.info('no checkpoint found, starting from scratch')
+
+        self._manifest['key'] = key
+        if 'stages' not in self._manifest:
+            self._manifest['stages'] = {}
+
+    def _path(self, stage):
+        return self._directory / f'{self._name}_{stage}.tif'
+
+    def _write_manifest(self):
+        fname = Path(self._manifest.filename)
+        tmp = fname.with_suffix('.tmp')
+        with open(tmp, 'wb') as out:
+            self._manifest.write(out)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp, fname)
+
+    def done(self, stage):
+        """check whether stage has completed"""
+        stages = self._manifest['stages']
+        if stage not in stages:
+            return False
+        # make sure the stage output has not been changed since
+        return Path(stages[stage]['path']).is_file() and \
+            fingerprint(stages[stage]['path']) == stages[stage]['fingerprint']
+
+    def mark(self, stage, fname):
+        """record that stage has completed and produced file fname"""
+        fname = str(fname)
+        _sync(fname)
+        self._manifest['stages'][stage] = {
+            'path': fname, 'fingerprint': fingerprint(fname)}
+        self._write_manifest()
+        logging.info(f'checkpoint {stage}')
+
+    def save(self, stage, data):
+        """store the result of stage
+
+        Parameters
+        ----------
+        stage: name of stage
+        data: xarray containing the result
+        """
+        fname = self._path(stage)
+        tmp = fname.with_suffix('.tmp.tif')
+        write_raster(data, tmp)
+        os.replace(tmp, fname)
+        self.mark(stage, fname)
+
+    def path(self, stage):
+        """name of the file holding the result of stage"""
+        return self._manifest['stages'][stage]['path']
+
+    def read(self, stage, out):
+        """read the result of stage into an array
+
+        Parameters
+        ----------
+        stage: name of stage
+        out: numpy array of shape (bands, rows, columns)
+        """
+        with rasterio.open(self.path(stage)) as ds:
+            ds.read(out=out)
+        return out
+
+    def finish(self):
+        """remove the checkpoint after the run has completed
+
+        The directory is removed as well unless it holds the checkpoint of
+        another program or other files.
+        """
+        for stage in self._manifest['stages']:
+            fname = self._path(stage)
+            if fname.is_file():
+                fname.unlink()
+        Path(self._manifest.filename).unlink(missing_ok=True)
+        try:
+            self._directory.rmdir()
+        except OSError:
+            # the directory is not empty
+            pass
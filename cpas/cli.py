@@ -0,0 +1,179 @@
+# This file is part of cpas.
+#
+# cpas is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cpas is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cpas.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2020 cpas team
+
+# The command line arguments of all programs are defined here. This module
+# must not import any of the heavy dependencies so that parsing arguments
+# and printing help is fast. The module implementing a command is only
+# imported once its arguments have been parsed.
+
+import argparse
+import importlib
+
+
+def _config(parser):
+    parser.add_argument('config', metavar='CFG',
+                        help="name of configuration file")
+
+
+def _resume(parser):
+    parser.add_argument('-r', '--resume', default=False, action="store_true",
+                        help="resume from the last completed stage")
+
+
+def compute_arguments(parser):
+    _config(parser)
+    _resume(parser)
+
+
+def path_arguments(parser):
+    _config(parser)
+    _resume(parser)
+
+
+def plot_arguments(parser):
+    _config(parser)
+    parser.add_argument('-s', '--speed-surface', metavar='GEOTIFF',
+                        help="load speed surface from GEOTIFF")
+    parser.add_argument('-l', '--show-destination-locations', default=False,
+                        action="store_true",
+                        help="show locations of destinations")
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help="save figure to FILE")
+
+
+def validate_arguments(parser):
+    parser.add_argument('config', metavar='CFG', nargs='+',
+                        help="name of configuration file")
+
+
+def batch_arguments(parser):
+    parser.add_argument('config', metavar='CFG', nargs='+',
+                        help="name of configuration file of a region")
+    parser.add_argument('-n', '--nprocs', type=int, default=1,
+                        help="maximum number of regions run at the same time")
+    parser.add_argument('-m', '--memory-limit', metavar='SIZE',
+                        help="total memory available to all regions, eg 256G")
+    parser.add_argument('-s', '--stage', choices=['compute', 'path'],
+                        action='append',
+                        help="run only the selected stage, can be repeated")
+    parser.add_argument('-r', '--resume', default=False, action="store_true",
+                        help="resume regions from their last completed stage")
+
+
+def query_arguments(parser):
+    _config(parser)
+    parser.add_argument('-f', '--file', metavar='GEOTIFF',
+                        help="query GEOTIFF instead of the cost path output")
+    parser.add_argument('--host', default='localhost',
+                        help="address to listen on")
+    parser.add_argument('-p', '--port', type=int, default=8000,
+                        help="port to listen on")
+    parser.add_argument('--max-cells', type=int, default=2**24,
+                        help="maximum number of cells of a bounding box "
+                        "query")
+
+
+def isochrones_arguments(parser):
+    _config(parser)
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help="write isochrones to GeoPackage FILE")
+
+
+def routes_arguments(parser):
+    _config(parser)
+    parser.add_argument('origins', metavar='ORIGINS',
+                        help="name of file containing the origin locations")
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help="write routes to GeoPackage FILE")
+    parser.add_argument('--id', metavar='COLUMN',
+                        help="name of column identifying the origins")
+
+
+def diff_arguments(parser):
+    parser.add_argument('reference', metavar='REFERENCE',
+                        help="name of reference raster, or of directory "
+                        "containing the reference outputs with --config")
+    parser.add_argument('other', metavar='OTHER', nargs='?',
+                        help="name of raster compared to the reference")
+    parser.add_argument('-c', '--config', metavar='CFG',
+                        help="compare the outputs of configuration CFG with "
+                        "those in the REFERENCE directory")
+    parser.add_argument('--rtol', type=float, default=0.,
+                        help="relative tolerance, default 0")
+    parser.add_argument('--atol', type=float, default=0.,
+                        help="absolute tolerance, default 0")
+    parser.add_argument('-t', '--tile-size', type=int, default=1024,
+                        help="number of rows and columns of the tiles "
+                        "compared, default 1024")
+    parser.add_argument('-n', '--nprocs', type=int, default=1,
+                        help="number of processes")
+    parser.add_argument('--heatmap', metavar='GEOTIFF',
+                        help="write the fraction of differing cells of each "
+                        "tile to GEOTIFF")
+
+
+# command name: (module, help, function adding the arguments)
+COMMANDS = {
+    'compute': ('.compute', 'compute the cost surfaces',
+                compute_arguments),
+    'path': ('.least_cost_path', 'compute the travel times',
+             path_arguments),
+    'plot': ('.plot', 'plot the travel times', plot_arguments),
+    'validate': ('.check', 'check configuration files and inputs',
+                 validate_arguments),
+    'batch': ('.batch', 'process many regions', batch_arguments),
+    'query': ('.query', 'serve travel time queries', query_arguments),
+    'isochrones': ('.isochrones', 'export travel time bands as polygons',
+                   isochrones_arguments),
+    'routes': ('.routes', 'extract routes to the nearest destination',
+               routes_arguments),
+    'diff': ('.diff', 'compare two rasters', diff_arguments),
+}
+
+
+def parse_args(command, argv=None):
+    """parse the arguments of a command run as a separate program
+
+    Parameters
+    ----------
+    command: name of command
+    argv: list of arguments, by default the program arguments
+
+    Returns
+    -------
+    the parsed arguments
+    """
+
+    parser = argparse.ArgumentParser()
+    COMMANDS[command][2](parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='cpas')
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND',
+                                       required=True)
+    for name, (module, help, add_arguments) in COMMANDS.items():
+        add_arguments(subparsers.add_parser(name, help=help))
+    args = parser.parse_args(argv)
+
+    module = importlib.import_module(COMMANDS[args.command][0], __package__)
+    module.main(args)
+
+
+if __name__ == '__main__':
+    main()
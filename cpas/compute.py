@@ -15,18 +15,26 @@
 #
 # Copyright (C) 2020 cpas team
 
+import gc
 import logging
-import sys
 
-import rioxarray
-import fiona
-import xarray
 import numpy
+from affine import Affine
+from rasterio.warp import transform_bounds
 from . import costsurface
+from . import inputs
+from .budget import MemoryBudget
+from .checkpoint import Checkpoint, run_key
+from .cli import parse_args
 from .config import CpasConfig
+from .fingerprint import fingerprint
+from .geodesy import cell_size
+from .multires import coarsen_cost
+from .scratch import ScratchSpace
+from .vector import is_columnar
 
 
-def speed_to_cost(speed, child_impact=1):
+def speed_to_cost(speed, child_impact=1, cellsize=None):
     """
     convert speed surface to cost surface
 
@@ -36,89 +44,288 @@ def speed_to_cost(speed, child_impact=1):
           in km/h
     child_impact: factor applied when traveling
           with a child (default=1))
+    cellsize: size of a grid cell in metres, either a number or a column
+          vector containing the size of the cells of each row
+          (default: computed from the grid of speed)
 
     Return
     ------
     cost surface
     """
 
+    if cellsize is None:
+        cellsize = cell_size(speed)
+
     # apply child impact factor and convert to m/s
     cost = speed * child_impact * 1000 / 3600
     # compute the costsurface, ie time.
-    # the factor 111120 converts degree to m close to the equator
-    return abs(speed.rio.resolution()[0]) * 111120 / cost
+    return cellsize / cost
 
 
-def main():
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+def clip_to(raster, like, pad=2):
+    """select the part of a raster covering another raster
 
-    cfg = CpasConfig()
-    cfg.read(sys.argv[1])
-
-    # load the landcover - speedmap and the landcover dataset
-    lc_speedmap = costsurface.readLandcoverSpeedMap(
-        cfg.landcover_ws,
-        landcover=cfg.landcover_cfg['landcover_type_column'],
-        speed=cfg.landcover_cfg['speed_column']
-    )
-    logging.info('loading landcovers')
-    landcover = rioxarray.open_rasterio(cfg.landcover, masked=True)
-    # compute the speed surface due to the landcover
-    logging.info('constructing landcover speed cost surface')
-    lws = costsurface.applyLandcoverSpeedMap(landcover, lc_speedmap)
+    Only the selected part of a lazily opened raster is read. This avoids
+    reading all of a large, eg continental, dataset.
+
+    Parameters
+    ----------
+    raster: xarray to be clipped
+    like: xarray defining the area of interest
+    pad: number of cells of raster added around the area of interest
+
+    Returns
+    -------
+    the clipped xarray
+    """
+
+    rx, ry = raster.rio.resolution()
+    minx, miny, maxx, maxy = like.rio.bounds()
+    if raster.rio.crs != like.rio.crs:
+        # the bounds of the reprojected area of interest, densified along
+        # its edges
+        minx, miny, maxx, maxy = transform_bounds(
+            like.rio.crs, raster.rio.crs, minx, miny, maxx, maxy)
+    return raster.rio.clip_box(minx - pad * abs(rx), miny - pad * abs(ry),
+                               maxx + pad * abs(rx), maxy + pad * abs(ry))
+
+
+def slope_impact(dem, like, out, blocks):
+    """compute the slope impact on the grid of another raster
+
+    The impact is computed for a block of rows at a time. Each block is
+    extended by a row on either side so that the gradients are the same as
+    those computed for the whole grid.
+
+    Parameters
+    ----------
+    dem: xarray containing the digital elevation model, only the parts
+         covering a block are read
+    like: xarray defining the grid
+    out: xarray on the grid of like used to store the slope impact
+    blocks: iterable of slices selecting blocks of rows
+    """
+
+    height, width = like.shape[-2:]
+    transform = like.rio.transform()
+    for rows in blocks:
+        start = max(rows.start - 1, 0)
+        stop = min(rows.stop + 1, height)
+        grid = like[:, start:stop, :]
+        # reproject onto the rows of the grid using its transform and
+        # coordinates, those recalculated from a few rows contain rounding
+        # errors
+        block = clip_to(dem, grid).rio.reproject(
+            like.rio.crs, shape=(stop - start, width),
+            transform=transform * Affine.translation(0, start))
+        block = block.assign_coords(x=grid['x'].values, y=grid['y'].values)
+        impact = costsurface.computeSlopeImpact(block)
+        out.values[:, rows, :] = impact.values[
+            :, rows.start - start:rows.stop - start, :]
+        # the rio accessors form reference cycles which would keep the
+        # arrays of the previous blocks alive
+        del block, impact
+        gc.collect()
+
+
+def road_speed_surface(cfg, landcover, scratch, band_rows=None):
+    """compute the speed surface due to the roads
+
+    Parameters
+    ----------
+    cfg: cpas configuration
+    landcover: xarray defining the grid
+    scratch: scratch space used for allocating intermediate arrays
+    band_rows: number of rows per band when rasterizing roads in parallel
+
+    Returns
+    -------
+    an xarray containing the road speed surface
+    """
 
     # load the road - speedmap and the road dataset
-    r_speedmap = costsurface.readRoadSpeedMap(
-        cfg.roads_ws,
-        road=cfg.roads_cfg['road_type_column'],
-        speed=cfg.roads_cfg['speed_column']
-    )
+    r_speedmap = inputs.read_road_speed_map(cfg)
     logging.info('loading roads')
-    roads = fiona.open(cfg.roads)
+    # only the roads touching the grid are read from columnar files
+    rx, ry = landcover.rio.resolution()
+    minx, miny, maxx, maxy = landcover.rio.bounds()
+    bbox = (minx - abs(rx), miny - abs(ry), maxx + abs(rx), maxy + abs(ry))
+    roads = inputs.open_roads(cfg.roads, bbox=bbox)
+    # reuse the road type match table unless the inputs have changed
+    fingerprints = {'speeds': fingerprint(cfg.roads_ws, content=True),
+                    'roads': fingerprint(cfg.roads)}
+    if is_columnar(cfg.roads):
+        # the road types are matched to those of the roads read
+        fingerprints['bounds'] = ' '.join(str(b) for b in bbox)
+    road_type_match = costsurface.readRoadTypeMatch(cfg.road_type_match,
+                                                    fingerprints)
+    if road_type_match is None:
+        logging.info('matching road types')
+        road_type_match = costsurface.matchRoadTypes(roads, r_speedmap)
+        costsurface.writeRoadTypeMatch(cfg.road_type_match, road_type_match,
+                                       fingerprints)
     logging.info('constructing road speed cost surface')
-    rws = costsurface.rasterizeAllRoads(roads, landcover, r_speedmap)
+    return costsurface.rasterizeAllRoads(roads, landcover, r_speedmap,
+                                         road_type_match=road_type_match,
+                                         nprocs=cfg.nprocs,
+                                         band_rows=band_rows,
+                                         out=scratch.zeros_like(landcover))
+
+
+def cost_surface(cfg, landcover, scratch, ckpt, band_rows=None):
+    """compute the cost surface with water being impassable
+
+    Parameters
+    ----------
+    cfg: cpas configuration
+    landcover: lazily read xarray containing the landcover
+    scratch: scratch space used for allocating intermediate arrays
+    ckpt: checkpoint recording completed stages
+    band_rows: number of rows per band when rasterizing roads in parallel
+
+    Returns
+    -------
+    an xarray containing the cost surface
+    """
+
+    cellsize = cell_size(landcover)
+
+    # load the landcover - speedmap
+    lc_speedmap = inputs.read_landcover_speed_map(cfg)
+    # compute the speed surface due to the landcover
+    logging.info('constructing landcover speed cost surface')
+    lws = scratch.zeros_like(landcover)
+    for rows in scratch.blocks(lws):
+        costsurface.applyLandcoverSpeedMap(landcover[:, rows, :].load(),
+                                           lc_speedmap, out=lws[:, rows, :])
+
+    if ckpt.done('roads'):
+        logging.info('loading road speed cost surface')
+        rws = scratch.zeros_like(landcover)
+        ckpt.read('roads', rws.values)
+    else:
+        rws = road_speed_surface(cfg, landcover, scratch, band_rows=band_rows)
+        ckpt.save('roads', rws)
 
-    # compute the slope impact and resample it
-    logging.info('loading DEM')
-    dem = rioxarray.open_rasterio(cfg.dem,
-                                  masked=True).rio.reproject_match(lws)
+    # compute the slope impact on the landcover grid
     logging.info('computing slope')
-    slope_impact = costsurface.computeSlopeImpact(dem)
-    # make sure coordinates are the same
-    # there might be some numerical noise after reprojecting the data
-    slope_impact['x'] = lws['x']
-    slope_impact['y'] = lws['y']
+    impact = scratch.zeros_like(lws, dtype=numpy.float64)
+    slope_impact(inputs.open_raster(cfg.dem), lws, impact,
+                 scratch.blocks(impact))
 
     # combine the two speed surfaces
     logging.info('combine cost surfaces')
-    ws = xarray.where(rws.notnull(), rws, lws)
+    ws = scratch.zeros_like(lws)
+    for rows in scratch.blocks(ws):
+        r = rws.values[:, rows, :]
+        ws.values[:, rows, :] = numpy.where(numpy.isnan(r),
+                                            lws.values[:, rows, :], r)
 
     # remove some of the large objects to free up some memory
     logging.info('tidy up some space')
-    del dem
     del lws
     del rws
 
     # compute cost surface
     logging.info('constructing cost surface')
-    cs = speed_to_cost(ws * slope_impact, cfg.child_impact)
+    cs = scratch.zeros_like(ws, dtype=numpy.float64)
+    for rows in scratch.blocks(cs):
+        cs.values[:, rows, :] = speed_to_cost(
+            ws.values[:, rows, :] * impact.values[:, rows, :],
+            cfg.child_impact, cellsize=cellsize[rows])
+
+    return cs
+
+
+def compute(cfg, scratch, ckpt, band_rows=None):
+    """compute the cost surfaces
+
+    Parameters
+    ----------
+    cfg: cpas configuration
+    scratch: scratch space used for allocating intermediate arrays
+    ckpt: checkpoint recording completed stages
+    band_rows: number of rows per band when rasterizing roads in parallel
+    """
+
+    # the landcover is read a block of rows at a time
+    landcover = inputs.open_raster(cfg.landcover)
+    cellsize = cell_size(landcover)
+
+    if ckpt.done('costsurface'):
+        logging.info('loading cost surface')
+        cs = scratch.zeros_like(landcover, dtype=numpy.float64)
+        ckpt.read('costsurface', cs.values)
+    else:
+        cs = cost_surface(cfg, landcover, scratch, ckpt, band_rows=band_rows)
+
+        # write costsurface
+        logging.info('writing cost surface')
+        scratch.write_raster(cs, cfg.costsurface)
+        ckpt.mark('costsurface', cfg.costsurface)
 
-    # write costsurface
-    logging.info('writing cost surface')
-    cs.rio.to_raster(cfg.costsurface)
+    if cfg.coarsen > 1:
+        # the road cells keep the coarse cells containing them fast
+        roads = scratch.zeros_like(landcover)
+        ckpt.read('roads', roads.values)
+        logging.info('writing coarse cost surface')
+        coarsen_cost(cs, cfg.coarsen, roads=roads).rio.to_raster(
+            cfg.costsurface_coarse)
 
     # consider water being passable
     # 10 is the code for open water
     logging.info('constructing water cost surface')
-    water = xarray.where(landcover == 10, cfg.waterspeed, numpy.NaN)
-    # convert water speed to time
-    # 1 as children arnt slower than adults on motor boats...
-    water = speed_to_cost(water)
-    cs = xarray.where(water.notnull(), water, cs)
+    for rows in scratch.blocks(cs):
+        w = numpy.where(landcover[:, rows, :].values == 10, cfg.waterspeed,
+                        numpy.nan)
+        # convert water speed to time
+        # 1 as children arnt slower than adults on motor boats...
+        w = speed_to_cost(w, cellsize=cellsize[rows])
+        cs.values[:, rows, :] = numpy.where(numpy.isnan(w),
+                                            cs.values[:, rows, :], w)
 
     # write output
     logging.info('writing water cost surface')
-    cs.rio.to_raster(cfg.costsurface_water)
+    scratch.write_raster(cs, cfg.costsurface_water)
+    if cfg.coarsen > 1:
+        logging.info('writing coarse water cost surface')
+        coarsen_cost(cs, cfg.coarsen, roads=roads).rio.to_raster(
+            cfg.costsurface_water_coarse)
+    ckpt.finish()
+
+
+def run(cfg, resume=False):
+    """compute the cost surfaces
+
+    Parameters
+    ----------
+    cfg: cpas configuration
+    resume: whether to resume from the last completed stage
+    """
+
+    # check the run fits into memory before doing any heavy work
+    budget = MemoryBudget(cfg.landcover, cfg.memory_limit)
+    block_rows, band_rows = budget.plan_compute(
+        memory_mapped=cfg.scratch is not None, nprocs=cfg.nprocs)
+
+    key = run_key(cfg, [cfg.landcover, cfg.landcover_ws, cfg.roads,
+                        cfg.roads_ws, cfg.dem])
+    ckpt = Checkpoint(cfg.checkpoints, 'compute', key, resume=resume)
+
+    with ScratchSpace(cfg.scratch, block_rows=block_rows) as scratch:
+        compute(cfg, scratch, ckpt, band_rows=band_rows)
+
+
+def main(args=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if args is None:
+        args = parse_args('compute')
+
+    cfg = CpasConfig()
+    cfg.read(args.config)
+
+    run(cfg, resume=args.resume)
 
 
 if __name__ == '__main__':
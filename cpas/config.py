@@ -72,12 +72,74 @@ costsurface_water = string
 cost_path = string
 invalid_loc = string(default=invalid_loc.csv)
 invalid_loc_water = string(default=invalid_loc_water.csv)
+# table matching the road types of the speed map to the road types of the
+# road layer. The table is recomputed when either input changes and can be
+# reviewed and edited otherwise
+road_type_match = string(default=road_type_match.cfg)
 
 # by default the maximum road speed is taken for each pixel. You can speed up
 # the road rasterisation process and reduce memory usage by setting this value
 # to False. All roads are processed in no particular order thus some cells
 # might end up with a slower speed.
-take_max_road_speed = bool(default=True)
+take_max_road_speed = boolean(default=True)
+
+# number of processes used for rasterising the roads. The grid is split
+# into bands which are processed in parallel
+nprocs = integer(min=1, default=1)
+
+# directory for memory mapped intermediate arrays. When set the
+# intermediate grids are stored in temporary files which are removed at the
+# end of the run. This allows processing grids larger than the available
+# memory. By default all intermediate arrays are held in memory.
+scratch = string(default=None)
+
+# memory available to the run, eg 64G. When set the sizes of the blocks
+# processed at a time are chosen to fit and the run stops before doing any
+# heavy work if it is estimated not to fit.
+memory_limit = string(default=None)
+
+# directory for storing checkpoints used to resume interrupted runs
+checkpoints = string(default=checkpoints)
+
+# keep the tracebacks of the least cost path computation. They are needed
+# for extracting the routes to the nearest destinations
+keep_traceback = boolean(default=False)
+traceback = string(default=traceback.npy)
+traceback_water = string(default=traceback_water.npy)
+# name of GeoPackage file the routes are written to
+routes = string(default=routes.gpkg)
+
+# number of nearest destinations. When larger than 1 the travel times to
+# the nearest, second nearest, ... destination are written to separate
+# bands of the cost path output
+k_nearest = integer(min=1, max=255, default=1)
+
+# coarsening factor for computing the travel times at multiple resolutions.
+# When larger than 1 the cost surfaces are also written at a resolution
+# coarsened by this factor. The travel times are first computed on the
+# coarse grid and then recomputed at the native resolution for the cells
+# within refine_time hours of a destination. Coarse travel times are used
+# elsewhere. The cost surfaces are still computed at the native resolution.
+coarsen = integer(min=1, default=1)
+refine_time = float(min=0, default=1)
+costsurface_coarse = string(default=costsurface_coarse.tif)
+costsurface_water_coarse = string(default=costsurface_water_coarse.tif)
+
+# reduce the memory needed by the least cost path computation by avoiding
+# copies of the grids. The travel times are stored as float32 and written
+# block by block. It cannot be combined with coarsen.
+lean_memory = boolean(default=False)
+
+[isochrones]
+# upper limits of the travel time bands in hours
+bands = float_list(default=list(0.5, 1, 2))
+# name of GeoPackage file the isochrones are written to
+name = string(default=isochrones.gpkg)
+# tolerance for simplifying the polygons in map units, 0 disables it
+simplify = float(min=0, default=0)
+# the travel time raster is processed in tiles of this number of rows
+# and columns
+tile_size = integer(min=1, default=1024)
 
 [plotting]
 # map projection for plotting
@@ -220,10 +282,96 @@ class CpasConfig:
         return str(self.outputbase / Path(
             self.cfg['outputs']['invalid_loc_water']))
 
+    @property
+    def road_type_match(self):
+        return str(self.outputbase / Path(
+            self.cfg['outputs']['road_type_match']))
+
     @property
     def take_max_road_speed(self):
         return self.cfg['outputs']['take_max_road_speed']
 
+    @property
+    def nprocs(self):
+        return self.cfg['outputs']['nprocs']
+
+    @property
+    def scratch(self):
+        if self.cfg['outputs']['scratch'] is None:
+            return None
+        return str(self.outputbase / Path(self.cfg['outputs']['scratch']))
+
+    @property
+    def memory_limit(self):
+        return self.cfg['outputs']['memory_limit']
+
+    @property
+    def checkpoints(self):
+        return str(self.outputbase / Path(self.cfg['outputs']['checkpoints']))
+
+    @property
+    def keep_traceback(self):
+        return self.cfg['outputs']['keep_traceback']
+
+    @property
+    def traceback(self):
+        if not self.keep_traceback:
+            return None
+        return str(self.outputbase / Path(self.cfg['outputs']['traceback']))
+
+    @property
+    def traceback_water(self):
+        if not self.keep_traceback:
+            return None
+        return str(self.outputbase / Path(
+            self.cfg['outputs']['traceback_water']))
+
+    @property
+    def routes(self):
+        return str(self.outputbase / Path(self.cfg['outputs']['routes']))
+
+    @property
+    def k_nearest(self):
+        return self.cfg['outputs']['k_nearest']
+
+    @property
+    def coarsen(self):
+        return self.cfg['outputs']['coarsen']
+
+    @property
+    def refine_time(self):
+        return self.cfg['outputs']['refine_time']
+
+    @property
+    def costsurface_coarse(self):
+        return str(self.outputbase / Path(
+            self.cfg['outputs']['costsurface_coarse']))
+
+    @property
+    def costsurface_water_coarse(self):
+        return str(self.outputbase / Path(
+            self.cfg['outputs']['costsurface_water_coarse']))
+
+    @property
+    def lean_memory(self):
+        return self.cfg['outputs']['lean_memory']
+
+    @property
+    def isochrones(self):
+        return str(self.outputbase / Path(self.cfg['isochrones']['name']))
+
+    @property
+    def isochrone_bands(self):
+        return self.cfg['isochrones']['bands']
+
+    @property
+    def isochrone_simplify(self):
+        return self.cfg['isochrones']['simplify']
+
+    @property
+    def isochrone_tile_size(self):
+        return self.cfg['isochrones']['tile_size']
+
     @property
     def epsg_code(self):
         return self.cfg['plotting']['epsg_code']
@@ -243,7 +391,13 @@ if __name__ == '__main__':
     for c in ['landcover', 'roads', 'dem', 'landcover_ws', 'roads_ws',
               'child_impact', 'include_small_paths', 'waterspeed',
               'costsurface', 'costsurface_water', 'invalid_loc',
-              'invalid_loc_water', 'take_max_road_speed', 'epsg_code']:
+              'invalid_loc_water', 'road_type_match', 'take_max_road_speed',
+              'nprocs', 'scratch', 'memory_limit', 'checkpoints',
+              'keep_traceback', 'traceback', 'traceback_water', 'routes',
+              'k_nearest', 'coarsen', 'refine_time', 'costsurface_coarse',
+              'costsurface_water_coarse', 'lean_memory', 'isochrones',
+              'isochrone_bands', 'isochrone_simplify',
+              'isochrone_tile_size', 'epsg_code']:
         print(c, getattr(cfg, c))
 
     pprint(cfg.landcover_cfg)
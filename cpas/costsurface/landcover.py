@@ -55,7 +55,7 @@ def readLandcoverSpeedMap(fname, landcover='Code',
 
 
 def applyLandcoverSpeedMap(landcover: xarray.DataArray,
-                           speedmap) -> xarray.DataArray:
+                           speedmap, out=None) -> xarray.DataArray:
     """convert a landcover surface to a speed surface using a map
 
     Parameters
@@ -63,6 +63,8 @@ def applyLandcoverSpeedMap(landcover: xarray.DataArray,
     landcover:  a 2D xarray containg the landcover
     map: a tuple with two arrays containing the landcover type and
          associated speed
+    out: optional float32 xarray of the same shape as landcover used to
+         store the speed surface
 
     Returns
     -------
@@ -71,7 +73,10 @@ def applyLandcoverSpeedMap(landcover: xarray.DataArray,
 
     landcover_types, speed_values = speedmap
 
-    speedsurface = xarray.zeros_like(landcover, dtype=numpy.float32)
+    if out is None:
+        speedsurface = xarray.zeros_like(landcover, dtype=numpy.float32)
+    else:
+        speedsurface = out
     speedsurface.values[:] = numpy.nan
 
     # consider only pixels with interesting data
@@ -15,13 +15,20 @@
 #
 # Copyright (C) 2020 cpas team
 
-__all__ = ['readRoadSpeedMap', 'rasterizeAllRoads']
+__all__ = ['readRoadSpeedMap', 'matchRoadTypes', 'readRoadTypeMatch',
+           'writeRoadTypeMatch', 'rasterizeAllRoads']
 
+import math
+from concurrent.futures import ProcessPoolExecutor
 import numpy
 import xarray
 import pandas
+import fiona
+import geopandas
+from configobj import ConfigObj
 from fuzzywuzzy import process
-from rasterio import features
+from rasterio import features, windows
+from ..vector import ROAD_TAG as TAG, is_columnar, read_columnar
 
 
 def readRoadSpeedMap(fname, road='Feature_Class',
@@ -51,35 +58,150 @@ def readRoadSpeedMap(fname, road='Feature_Class',
     return costs[speed]
 
 
-def rasterizeRoads(roads, landcover, road_speed_map):
+def _roadTags(roads):
+    """the road types of all roads of a vector layer"""
+    if isinstance(roads, geopandas.GeoDataFrame):
+        return roads[TAG].unique()
+    return [feature['properties'][TAG] for feature in roads]
+
+
+def _roadShapes(roads, road_speed_map):
+    """generate pairs of geometry and speed of the roads in the speed map"""
+    if isinstance(roads, geopandas.GeoDataFrame):
+        # select and map the road types of all roads at once
+        speeds = roads[TAG].map(road_speed_map)
+        selected = speeds.notna().to_numpy()
+        return zip(roads.geometry.values[selected],
+                   speeds.to_numpy()[selected])
+    return ((f['geometry'], road_speed_map[f['properties'][TAG]])
+            for f in roads if f['properties'][TAG] in road_speed_map)
+
+
+def _roadsPath(roads):
+    """the name of the file a vector layer was read from"""
+    if isinstance(roads, geopandas.GeoDataFrame):
+        return roads.attrs['path']
+    return roads.path
+
+
+def matchRoadTypes(roads, road_speed_map):
+    """match road types of speed map to road types of the vector layer
+
+    The road types used in the speed map do not necessarily match the
+    tags used in the vector layer. Find the closest road type using
+    fuzzy matching.
+
+    Parameters
+    ----------
+    roads: roads vector layer, either a fiona collection or a geopandas
+           data frame
+    road_speed_map: pandas series containing speeds
+
+    Returns
+    -------
+    dictionary mapping speed map road type to vector layer road type
+    """
+
+    # extract road types from road shapefile
+    road_types = set(_roadTags(roads))
+
+    match = {}
+    for rt in road_speed_map.index:
+        matched_rt = process.extractOne(str(rt), road_types)[0]
+        print(f'using matched road type {matched_rt} for {rt}')
+        match[str(rt)] = matched_rt
+    return match
+
+
+def readRoadTypeMatch(fname, fingerprints):
+    """read road type match table
+
+    Parameters
+    ----------
+    fname: name of file containing the road type match table
+    fingerprints: dictionary of input fingerprints the table must match
+
+    Returns
+    -------
+    dictionary mapping speed map road type to vector layer road type or
+    None if the file does not exist or the inputs have changed
+    """
+
+    try:
+        table = ConfigObj(str(fname), file_error=True)
+    except IOError:
+        return None
+
+    for k in fingerprints:
+        if table.get(k) != fingerprints[k]:
+            return None
+    if 'road_types' not in table:
+        return None
+    return table['road_types'].dict()
+
+
+def writeRoadTypeMatch(fname, match, fingerprints):
+    """write road type match table
+
+    The table can be reviewed and edited. It is reused as long as the
+    fingerprints of the inputs do not change.
+
+    Parameters
+    ----------
+    fname: name of file to store the road type match table in
+    match: dictionary mapping speed map road type to vector layer road type
+    fingerprints: dictionary of input fingerprints
+    """
+
+    table = ConfigObj()
+    table.filename = str(fname)
+    table.initial_comment = [
+        'road type match table',
+        'maps road types of the speed map to road types of the road layer',
+        'the table is recomputed when the fingerprints change']
+    for k in fingerprints:
+        table[k] = fingerprints[k]
+    table['road_types'] = match
+    table.write()
+
+
+def rasterizeRoads(roads, landcover, road_speed_map,
+                   out_shape=None, transform=None):
     """rasterize roads
 
     Parameters
     ----------
-    roads: roads vector layer
+    roads: roads vector layer, either a fiona collection or a geopandas
+           data frame
     landcover: xarry used for creating empty array
     road_speed_map: dictionary mapping road type to travel speed
+    out_shape: shape of output array, default: shape of landcover
+    transform: affine transform of output array,
+               default: transform of landcover
 
     Returns
     -------
     an xarray containing the speed surface
     """
 
-    # construct filter selecting all roads of a particular type
-    filtered = filter(lambda f: f['properties']['tag'] in road_speed_map,
-                      roads)
+    if out_shape is None:
+        out_shape = landcover.rio.shape
+    if transform is None:
+        transform = landcover.rio.transform()
 
+    # select all roads of a particular type
     speedsurface = features.rasterize(
-        ((f['geometry'],
-          road_speed_map[f['properties']['tag']]) for f in filtered),
-        out_shape=landcover.rio.shape,
-        transform=landcover.rio.transform(),
+        _roadShapes(roads, road_speed_map),
+        out_shape=out_shape,
+        transform=transform,
         all_touched=True)
 
     return speedsurface
 
 
-def rasterizeAllRoads(roads, landcover, road_speed_map, maxspeed=True):
+def rasterizeAllRoads(roads, landcover, road_speed_map, maxspeed=True,
+                      road_type_match=None, nprocs=1, band_rows=None,
+                      out=None):
     """rasterize all roads
 
     Parameters
@@ -89,38 +211,52 @@ def rasterizeAllRoads(roads, landcover, road_speed_map, maxspeed=True):
     road_speed_map: pandas series containing speeds
     maxspeed: when set to False road types are not ordered and slower
               road speeds might override faster speeds
+    road_type_match: dictionary mapping speed map road types to road types
+              in the vector layer. When not set the road types are matched
+              using matchRoadTypes
+    nprocs: number of processes used for rasterizing the roads. When
+              larger than 1 the grid is split into bands of rows which are
+              rasterized in parallel
+    band_rows: number of rows per band when rasterizing in parallel
+    out: optional float32 xarray of the same shape as landcover used to
+              store the speed surface
 
     Returns
     -------
     an xarray containing the speed surface
     """
 
-    # extract road types from road shapefile
-    road_types = set([feature['properties']['tag'] for feature in roads])
+    if road_type_match is None:
+        road_type_match = matchRoadTypes(roads, road_speed_map)
 
     # modify index so that it matches the road types in the vector layer
-    idx = road_speed_map.index.to_list()
-    for i, rt in enumerate(idx):
-        matched_rt = process.extractOne(rt, road_types)[0]
-        print(f'using matched road type {matched_rt} for {rt}')
-        idx[i] = matched_rt
-    road_speed_map.index = idx
+    road_speed_map.index = [road_type_match.get(str(rt), rt)
+                            for rt in road_speed_map.index]
 
-    if maxspeed:
-        rcost = rasterizeAllRoadsMax(roads, landcover, road_speed_map)
+    if out is None:
+        speedsurface = xarray.zeros_like(landcover, dtype=numpy.float32)
+    else:
+        speedsurface = out
+    # the roads are rasterized straight into the speed surface
+    rcost = speedsurface.values[0]
+
+    if nprocs > 1:
+        rasterizeRoadsParallel(_roadsPath(roads), landcover, road_speed_map,
+                               maxspeed=maxspeed, nprocs=nprocs,
+                               band_rows=band_rows, out=rcost)
+    elif maxspeed:
+        rasterizeAllRoadsMax(roads, landcover, road_speed_map, out=rcost)
     else:
-        rcost = rasterizeRoads(roads, landcover, road_speed_map.to_dict())
+        rcost[:] = rasterizeRoads(roads, landcover, road_speed_map.to_dict())
 
     # replace fill values with nans
-    rcost = numpy.where(rcost == 0, numpy.nan, rcost)
-
-    speedsurface = xarray.zeros_like(landcover, dtype=numpy.float32)
-    speedsurface.values[0, :, :] = rcost[:, :]
+    rcost[rcost == 0] = numpy.nan
 
     return speedsurface
 
 
-def rasterizeAllRoadsMax(roads, landcover, road_speed_map):
+def rasterizeAllRoadsMax(roads, landcover, road_speed_map,
+                         out_shape=None, transform=None, out=None):
     """rasterize all roads
 
     This version takes the largest speed when a pixel contains
@@ -131,27 +267,127 @@ def rasterizeAllRoadsMax(roads, landcover, road_speed_map):
     roads: roads vector layer
     landcover: xarry used for creating empty array
     road_speed_map: dictionary mapping road type to travel speed
+    out_shape: shape of output array, default: shape of landcover
+    transform: affine transform of output array,
+               default: transform of landcover
+    out: optional float32 array of zeros used to store the speed surface
 
     Returns
     -------
     a numpy arrray containing the speed surface
     """
 
-    speedsurface = numpy.zeros(landcover.shape[1:], dtype=numpy.float32)
+    if out is None:
+        if out_shape is None:
+            out_shape = landcover.shape[1:]
+        speedsurface = numpy.zeros(out_shape, dtype=numpy.float32)
+    else:
+        speedsurface = out
+        out_shape = out.shape
 
     # loop over unique speed values to group roads by speed
     for speed in road_speed_map.unique():
         # select all roads with that speed
         selected_roads = road_speed_map[road_speed_map == speed]
-        rcost = rasterizeRoads(roads, landcover, selected_roads.to_dict())
+        rcost = rasterizeRoads(roads, landcover, selected_roads.to_dict(),
+                               out_shape=out_shape, transform=transform)
         # take max values
-        speedsurface = numpy.maximum(speedsurface, rcost)
+        numpy.maximum(speedsurface, rcost, out=speedsurface)
+
+    return speedsurface
+
+
+def _rasterizeBand(fname, window, transform, road_speed_map, maxspeed):
+    """rasterize the roads intersecting a window
+
+    Parameters
+    ----------
+    fname: name of roads vector layer
+    window: rasterio window to rasterize
+    transform: affine transform of the full grid
+    road_speed_map: pandas series containing speeds
+    maxspeed: whether to take the largest speed of a pixel
+
+    Returns
+    -------
+    a numpy array containing the speed surface of the window
+    """
+
+    out_shape = (window.height, window.width)
+    wtransform = windows.transform(window, transform)
+
+    # extend the window by a pixel so that all roads touching it are found
+    left, bottom, right, top = windows.bounds(window, transform)
+    dx = abs(transform.a)
+    dy = abs(transform.e)
+    bbox = (left - dx, bottom - dy, right + dx, top + dy)
+    if is_columnar(fname):
+        selected = read_columnar(fname, columns=[TAG], bbox=bbox)
+    else:
+        with fiona.open(fname) as roads:
+            selected = list(roads.filter(bbox=bbox))
+
+    if len(selected) == 0:
+        return numpy.zeros(out_shape, dtype=numpy.float32)
+
+    if maxspeed:
+        return rasterizeAllRoadsMax(selected, None, road_speed_map,
+                                    out_shape=out_shape, transform=wtransform)
+    else:
+        return rasterizeRoads(selected, None, road_speed_map.to_dict(),
+                              out_shape=out_shape, transform=wtransform)
+
+
+def rasterizeRoadsParallel(fname, landcover, road_speed_map, maxspeed=True,
+                           nprocs=2, band_rows=None, out=None):
+    """rasterize all roads using multiple processes
+
+    The grid is split into bands of rows. Each band is rasterized by a
+    separate process which only reads the roads intersecting the band.
+    The result is identical to rasterizing the whole grid at once.
+
+    Parameters
+    ----------
+    fname: name of roads vector layer
+    landcover: xarry used for creating empty array
+    road_speed_map: pandas series containing speeds
+    maxspeed: when set to False road types are not ordered and slower
+              road speeds might override faster speeds
+    nprocs: number of processes
+    band_rows: number of rows per band, default: split the grid into
+               four bands per process
+    out: optional float32 array used to store the speed surface
+
+    Returns
+    -------
+    a numpy arrray containing the speed surface
+    """
+
+    height, width = landcover.rio.shape
+    transform = landcover.rio.transform()
+    if band_rows is None:
+        band_rows = math.ceil(height / (4 * nprocs))
+
+    if out is None:
+        speedsurface = numpy.zeros((height, width), dtype=numpy.float32)
+    else:
+        speedsurface = out
+
+    with ProcessPoolExecutor(max_workers=nprocs) as executor:
+        jobs = {}
+        for row in range(0, height, band_rows):
+            window = windows.Window(0, row, width,
+                                    min(band_rows, height - row))
+            jobs[row] = executor.submit(_rasterizeBand, fname, window,
+                                        transform, road_speed_map, maxspeed)
+        for row in jobs:
+            band = jobs[row].result()
+            speedsurface[row:row + band.shape[0], :] = band
 
     return speedsurface
 
 
 if __name__ == '__main__':
-    import fiona
     import rioxarray
     from cpas.config import CpasConfig
     import sys
@@ -19,6 +19,7 @@ __all__ = ['computeSlopeImpact']
 
 import numpy
 import xarray
+from ..geodesy import metres_per_unit
 
 
 def computePercentageSlope(dem):
@@ -33,12 +34,19 @@ def computePercentageSlope(dem):
     array containing the percentage slope
     """
 
-    dx = dem.differentiate('x')
-    dy = dem.differentiate('y')
-    # the scaling factor of 111120 converts degrees to metres.
-    # this is a good approximation near the equator
-    slope = (dx * dx + dy * dy) ** 0.5 * 100 / 111120
-    return slope
+    # the gradients use the resolution of the grid rather than the
+    # differences of the coordinates, which contain rounding errors, so
+    # that the slope of a block of rows equals that of the whole grid
+    rx, ry = dem.rio.resolution()
+    gy, gx = numpy.gradient(dem.values, ry, rx, axis=(-2, -1))
+
+    # convert the gradients from per unit of the coordinates to per metre.
+    # for geographic coordinates the conversion depends on the latitude
+    mx, my = metres_per_unit(dem)
+    dx = gx / mx
+    dy = gy / my
+    slope = (dx * dx + dy * dy) ** 0.5 * 100
+    return dem.copy(data=slope)
 
 
 def slopespeed(slopes):
@@ -0,0 +1,270 @@
+# This file is part of cpas.
+#
+# cpas is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cpas is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cpas.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2020 cpas team
+
+import logging
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy
+import rasterio
+from affine import Affine
+from .cells import tile_windows
+from .cli import parse_args
+from .config import CpasConfig
+
+# characters used for the heatmap, from no to all cells of a tile differing
+RAMP = ' .:-=+*#%@'
+
+# statistics gathered for each tile
+COMPARED, NODATA, DIFFERING, SUM, MAX = range(5)
+
+
+def _read(ds, window):
+    """read all bands of a window replacing nodata values by NaN"""
+    data = ds.read(window=window, out_dtype=numpy.float64)
+    if ds.nodata is not None and not numpy.isnan(ds.nodata):
+        data[data == ds.nodata] = numpy.nan
+    return data
+
+
+def compare_window(reference, other, window, rtol=0., atol=0.):
+    """compare a window of two rasters
+
+    Parameters
+    ----------
+    reference: name of reference raster
+    other: name of raster compared to the reference
+    window: rasterio window to compare
+    rtol: relative tolerance
+    atol: absolute tolerance
+
+    Returns
+    -------
+    array containing the number of cells with data in both rasters, the
+    number of cells with data in only one raster, the number of cells
+    whose values differ by more than atol + rtol * abs(reference) and the
+    sum and maximum of the absolute differences
+    """
+
+    with rasterio.open(reference) as ds:
+        a = _read(ds, window)
+    with rasterio.open(other) as ds:
+        b = _read(ds, window)
+
+    missing_a = numpy.isnan(a)
+    missing_b = numpy.isnan(b)
+    valid = ~missing_a & ~missing_b
+    diff = numpy.abs(a[valid] - b[valid])
+
+    stats = numpy.zeros(5)
+    stats[COMPARED] = valid.sum()
+    stats[NODATA] = (missing_a != missing_b).sum()
+    stats[DIFFERING] = (diff > atol + rtol * numpy.abs(a[valid])).sum()
+    if len(diff) > 0:
+        stats[SUM] = diff.sum()
+        stats[MAX] = diff.max()
+    return stats
+
+
+def check_grids(reference, other):
+    """check two rasters use the same grid
+
+    Parameters
+    ----------
+    reference: name of reference raster
+    other: name of raster compared to the reference
+
+    Returns
+    -------
+    list of differences
+    """
+
+    with rasterio.open(reference) as a, rasterio.open(other) as b:
+        problems = []
+        if a.count != b.count:
+            problems.append(f'number of bands {a.count} != {b.count}')
+        if a.shape != b.shape:
+            problems.append(f'shape {a.shape} != {b.shape}')
+        if not a.transform.almost_equals(b.transform):
+            problems.append(f'transform {tuple(a.transform)} != '
+                            f'{tuple(b.transform)}')
+        # rasters without a CRS are assumed to use the CRS of the other
+        if a.crs is not None and b.crs is not None and a.crs != b.crs:
+            problems.append(f'CRS {a.crs} != {b.crs}')
+    return problems
+
+
+def compare_rasters(reference, other, rtol=0., atol=0., tile_size=1024,
+                    nprocs=1):
+    """compare two rasters tile by tile
+
+    Only a tile of each raster is held in memory by each process.
+
+    Parameters
+    ----------
+    reference: name of reference raster
+    other: name of raster compared to the reference
+    rtol: relative tolerance
+    atol: absolute tolerance
+    tile_size: number of rows and columns of a tile
+    nprocs: number of processes
+
+    Returns
+    -------
+    dictionary containing the summary statistics and the heatmap, an
+    array holding the fraction of differing cells of each tile
+    """
+
+    with rasterio.open(reference) as ds:
+        height, width = ds.shape
+        count = ds.count
+    tiles = list(tile_windows(width, height, tile_size))
+    logging.info(f'comparing {len(tiles)} tiles')
+
+    with ProcessPoolExecutor(max_workers=nprocs) as executor:
+        n = len(tiles)
+        stats = numpy.array(list(executor.map(
+            compare_window, [reference] * n, [other] * n, tiles,
+            [rtol] * n, [atol] * n)))
+
+    cells = numpy.array([w.height * w.width * count for w in tiles])
+    ny = -(-height // tile_size)
+    heatmap = (stats[:, NODATA] + stats[:, DIFFERING]) / cells
+    compared = stats[:, COMPARED].sum()
+    return {
+        'compared': int(compared),
+        'nodata': int(stats[:, NODATA].sum()),
+        'differing': int(stats[:, DIFFERING].sum()),
+        'max': stats[:, MAX].max(),
+        'mean': stats[:, SUM].sum() / compared if compared > 0 else 0.,
+        'heatmap': heatmap.reshape(ny, -1)}
+
+
+def format_heatmap(heatmap):
+    """draw the heatmap using characters
+
+    Parameters
+    ----------
+    heatmap: array of fractions of differing cells
+
+    Returns
+    -------
+    list of lines
+    """
+
+    levels = numpy.ceil(heatmap * (len(RAMP) - 1)).astype(int)
+    return ['|' + ''.join(RAMP[v] for v in row) + '|' for row in levels]
+
+
+def write_heatmap(fname, heatmap, reference, tile_size):
+    """write the heatmap to a GeoTIFF on the grid of tiles
+
+    Parameters
+    ----------
+    fname: name of output file
+    heatmap: array of fractions of differing cells
+    reference: name of reference raster
+    tile_size: number of rows and columns of a tile
+    """
+
+    with rasterio.open(reference) as ds:
+        transform = ds.transform * Affine.scale(tile_size)
+        crs = ds.crs
+    with rasterio.open(fname, 'w', driver='GTiff', height=heatmap.shape[0],
+                       width=heatmap.shape[1], count=1, dtype='float32',
+                       transform=transform, crs=crs) as ds:
+        ds.write(heatmap.astype(numpy.float32), 1)
+
+
+def report(reference, other, args, heatmap=None):
+    """compare two rasters and print a report
+
+    Parameters
+    ----------
+    reference: name of reference raster
+    other: name of raster compared to the reference
+    args: command line arguments holding the tolerances, tile size and
+          number of processes
+    heatmap: name of GeoTIFF file to write the heatmap to
+
+    Returns
+    -------
+    True if the rasters are equivalent
+    """
+
+    print(f'reference: {reference}')
+    print(f'other:     {other}')
+    problems = check_grids(reference, other)
+    if len(problems) > 0:
+        for p in problems:
+            print(f'  grids differ: {p}')
+        return False
+
+    result = compare_rasters(reference, other, rtol=args.rtol,
+                             atol=args.atol, tile_size=args.tile_size,
+                             nprocs=args.nprocs)
+    print(f"  cells compared:          {result['compared']}")
+    print(f"  nodata mismatches:       {result['nodata']}")
+    print(f"  differing cells:         {result['differing']}")
+    print(f"  max absolute difference: {result['max']:g}")
+    print(f"  mean absolute difference: {result['mean']:g}")
+    equal = result['nodata'] == 0 and result['differing'] == 0
+    if not equal:
+        print(f'  differing cells per {args.tile_size}x{args.tile_size} '
+              'tile:')
+        for line in format_heatmap(result['heatmap']):
+            print(f'  {line}')
+    if heatmap is not None:
+        write_heatmap(heatmap, result['heatmap'], reference, args.tile_size)
+    return equal
+
+
+def main(args=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if args is None:
+        args = parse_args('diff')
+
+    if args.config is None:
+        if args.other is None:
+            msg = 'need the names of two rasters or a configuration'
+            raise RuntimeError(msg)
+        pairs = [(args.reference, args.other, args.heatmap)]
+    else:
+        # compare the outputs of a run with those in a reference directory
+        cfg = CpasConfig()
+        cfg.read(args.config)
+        pairs = []
+        for name in ['costsurface', 'costsurface_water', 'cost_path']:
+            fname = Path(getattr(cfg, name))
+            heatmap = None
+            if args.heatmap is not None:
+                heatmap = Path(args.heatmap)
+                heatmap = heatmap.with_name(
+                    f'{heatmap.stem}_{name}{heatmap.suffix}')
+            pairs.append((Path(args.reference) / fname.name, fname,
+                          heatmap))
+
+    results = [report(r, o, args, heatmap=h) for r, o, h in pairs]
+    if not all(results):
+        print(f'{results.count(False)} of {len(results)} rasters differ')
+        sys.exit(1)
+    print('rasters are equivalent')
+
+
+if __name__ == '__main__':
+    main()
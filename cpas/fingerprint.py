@@ -0,0 +1,72 @@
+# This file is part of cpas.
+#
+# cpas is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cpas is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cpas.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2020 cpas team
+
+import hashlib
+from pathlib import Path
+
+
+def dataset_files(fname):
+    """list the files making up a dataset
+
+    A shapefile consists of several files sharing the same stem
+    (.shp, .dbf, .shx, .prj, ...). All of them are returned so that
+    a change to any of them changes the fingerprint.
+
+    Parameters
+    ----------
+    fname: name of the main dataset file
+
+    Returns
+    -------
+    sorted list of paths
+    """
+
+    fname = Path(fname)
+    if fname.suffix.lower() == '.shp':
+        return sorted(p for p in fname.parent.glob(fname.stem + '.*')
+                      if p.stem == fname.stem)
+    return [fname]
+
+
+def fingerprint(fname, content=False):
+    """compute a fingerprint of a dataset
+
+    Parameters
+    ----------
+    fname: name of the dataset
+    content: when set the fingerprint is computed from the file contents.
+             This is only sensible for small files such as the csv speed
+             maps. Otherwise the name, size and modification time of all
+             files making up the dataset are used.
+
+    Returns
+    -------
+    hex digest string
+    """
+
+    h = hashlib.sha256()
+    for p in dataset_files(fname):
+        if not p.is_file():
+            msg = f'no such file {p}'
+            raise RuntimeError(msg)
+        h.update(p.name.encode())
+        if content:
+            h.update(p.read_bytes())
+        else:
+            stat = p.stat()
+            h.update(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return h.hexdigest()
@@ -0,0 +1,89 @@
+# This file is part of cpas.
+#
+# cpas is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cpas is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cpas.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2020 cpas team
+
+import numpy
+
+# WGS84 ellipsoid
+SEMI_MAJOR_AXIS = 6378137.
+ECCENTRICITY2 = 6.69437999014e-3
+
+
+def metres_per_degree(lat):
+    """compute the length of a degree on the WGS84 ellipsoid
+
+    Parameters
+    ----------
+    lat: array of latitudes in degrees
+
+    Returns
+    -------
+    tuple of arrays containing the length in metres of a degree of
+    longitude and of a degree of latitude
+    """
+
+    phi = numpy.radians(lat)
+    w = 1 - ECCENTRICITY2 * numpy.sin(phi) ** 2
+    # radii of curvature in the prime vertical and the meridian
+    n = SEMI_MAJOR_AXIS / numpy.sqrt(w)
+    m = SEMI_MAJOR_AXIS * (1 - ECCENTRICITY2) / w ** 1.5
+    return numpy.radians(n * numpy.cos(phi)), numpy.radians(m)
+
+
+def metres_per_unit(raster):
+    """compute the length in metres of a unit of the grid coordinates
+
+    For grids using geographic coordinates the lengths depend on the
+    latitude and are computed for each row. Grids without a CRS are assumed
+    to use geographic coordinates.
+
+    Parameters
+    ----------
+    raster: xarray with y coordinates
+
+    Returns
+    -------
+    tuple of column vectors of shape (rows, 1) containing the length of a
+    unit along the x and the y axis for each row
+    """
+
+    crs = raster.rio.crs
+    rows = raster.sizes['y']
+    if crs is None or crs.is_geographic:
+        mx, my = metres_per_degree(raster['y'].values)
+    else:
+        factor = crs.linear_units_factor[1]
+        mx = my = numpy.full(rows, factor)
+    return mx.reshape(rows, 1), my.reshape(rows, 1)
+
+
+def cell_size(raster):
+    """compute the size of the grid cells in metres
+
+    The size is the side of a square with the same area as the cell.
+
+    Parameters
+    ----------
+    raster: xarray with y coordinates
+
+    Returns
+    -------
+    column vector of shape (rows, 1) containing the cell size of each row
+    """
+
+    rx, ry = raster.rio.resolution()
+    mx, my = metres_per_unit(raster)
+    return numpy.sqrt(abs(rx) * mx * abs(ry) * my)
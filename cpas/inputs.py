@@ -0,0 +1,141 @@
+# This file is part of cpas.
+#
+# cpas is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cpas is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cpas.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2020 cpas team
+
+# Batch runs process many regions which often share inputs such as a
+# continental DEM, road layer or speed maps. The loaders in this module
+# keep the parsed speed maps and opened datasets so that subsequent runs
+# using the same inputs can reuse them. Entries are keyed by the file name
+# and its fingerprint. Only the most recently used entries are kept, and
+# roads read into memory from columnar files are not cached at all, so
+# that a long running batch process does not accumulate the data of every
+# region.
+
+import logging
+from collections import OrderedDict
+import fiona
+import rioxarray
+from . import costsurface
+from .fingerprint import fingerprint
+from .vector import ROAD_TAG, is_columnar, read_columnar
+
+# maximum number of cached entries
+MAX_ENTRIES = 16
+
+_cache = OrderedDict()
+
+
+def _cached(key, fname, loader, content=False):
+    key = (key, str(fname), fingerprint(fname, content=content))
+    if key not in _cache:
+        _cache[key] = loader()
+        if len(_cache) > MAX_ENTRIES:
+            _cache.popitem(last=False)
+    else:
+        logging.info(f'reusing {fname}')
+        _cache.move_to_end(key)
+    return _cache[key]
+
+
+def clear():
+    """remove all cached inputs"""
+    _cache.clear()
+
+
+def read_landcover_speed_map(cfg):
+    """read the landcover to speed map
+
+    Parameters
+    ----------
+    cfg: cpas configuration
+
+    Returns
+    -------
+    tuple of two arrays containing the landcover type and the associated speed
+    """
+
+    column = cfg.landcover_cfg['landcover_type_column']
+    speed = cfg.landcover_cfg['speed_column']
+    return _cached(
+        ('landcover_speed_map', column, speed), cfg.landcover_ws,
+        lambda: costsurface.readLandcoverSpeedMap(
+            cfg.landcover_ws, landcover=column, speed=speed),
+        content=True)
+
+
+def read_road_speed_map(cfg):
+    """read the road type to speed map
+
+    Parameters
+    ----------
+    cfg: cpas configuration
+
+    Returns
+    -------
+    a pandas series containing speeds. The series is a copy which can be
+    modified.
+    """
+
+    column = cfg.roads_cfg['road_type_column']
+    speed = cfg.roads_cfg['speed_column']
+    return _cached(
+        ('road_speed_map', column, speed), cfg.roads_ws,
+        lambda: costsurface.readRoadSpeedMap(
+            cfg.roads_ws, road=column, speed=speed),
+        content=True).copy()
+
+
+def open_raster(fname):
+    """open a raster dataset
+
+    The data is read lazily and not kept in memory by the dataset. Use
+    compute() to obtain a loaded copy.
+
+    Parameters
+    ----------
+    fname: name of raster file
+
+    Returns
+    -------
+    an xarray with masked values
+    """
+
+    return _cached('raster', fname,
+                   lambda: rioxarray.open_rasterio(fname, masked=True,
+                                                   cache=False))
+
+
+def open_roads(fname, bbox=None):
+    """open a roads vector layer
+
+    GeoParquet and Arrow IPC files are read into memory keeping only the
+    road types and geometries. As they are specific to the bounding box
+    they are not cached.
+
+    Parameters
+    ----------
+    fname: name of vector layer
+    bbox: only read the roads of columnar files intersecting the bounding
+          box (minx, miny, maxx, maxy)
+
+    Returns
+    -------
+    a fiona collection or a geopandas data frame for columnar files
+    """
+
+    if is_columnar(fname):
+        return read_columnar(fname, columns=[ROAD_TAG], bbox=bbox)
+    return _cached('roads', fname, lambda: fiona.open(fname))
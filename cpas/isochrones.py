@@ -0,0 +1,146 @@
+# This file is part of cpas.
+#
+# cpas is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cpas is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cpas.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2020 cpas team
+
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+import rasterio
+import geopandas
+from affine import Affine
+from rasterio import features
+from shapely import wkb
+from shapely.affinity import affine_transform
+from shapely.geometry import shape
+from shapely.ops import unary_union
+from .cells import tile_windows
+from .cli import parse_args
+from .config import CpasConfig
+
+
+def polygonize_tile(fname, window, thresholds):
+    """polygonize the travel time bands of a tile
+
+    The polygons are returned in pixel coordinates of the whole grid. The
+    vertices are therefore integers so that polygons of neighbouring tiles
+    share their edges exactly.
+
+    Parameters
+    ----------
+    fname: name of travel time raster
+    window: rasterio window of tile
+    thresholds: list of upper limits of the bands in seconds
+
+    Returns
+    -------
+    list containing a list of polygons for each band stored as WKB
+    """
+
+    with rasterio.open(fname) as ds:
+        data = ds.read(1, window=window, masked=True).filled(numpy.nan)
+
+    transform = Affine.translation(window.col_off, window.row_off)
+    polygons = []
+    for threshold in thresholds:
+        # comparisons with NaN are always False
+        with numpy.errstate(invalid='ignore'):
+            mask = data <= threshold
+        polygons.append([
+            shape(geom).wkb for geom, value in features.shapes(
+                mask.astype(numpy.uint8), mask=mask, transform=transform)])
+    return polygons
+
+
+def compute_isochrones(fname, bands, tile_size=1024, simplify=0., nprocs=1,
+                       crs=None):
+    """compute isochrone polygons from a travel time raster
+
+    The raster is processed in tiles which are polygonized in parallel.
+    The polygons of all tiles are then dissolved for each band.
+
+    Parameters
+    ----------
+    fname: name of travel time raster containing times in seconds
+    bands: list of upper limits of the travel time bands in hours
+    tile_size: number of rows and columns of a tile
+    simplify: tolerance for simplifying polygons in map units,
+              0 disables simplification
+    nprocs: number of processes
+    crs: CRS of the polygons if the raster has none, eg rasters written
+         without a CRS by earlier versions
+
+    Returns
+    -------
+    geopandas data frame containing a multipolygon for each band
+    """
+
+    bands = sorted(bands)
+    thresholds = [b * 3600 for b in bands]
+
+    with rasterio.open(fname) as ds:
+        transform = ds.transform
+        if ds.crs is not None:
+            crs = ds.crs
+        tiles = list(tile_windows(ds.width, ds.height, tile_size))
+
+    logging.info(f'polygonizing {len(tiles)} tiles')
+    parts = [[] for b in bands]
+    with ProcessPoolExecutor(max_workers=nprocs) as executor:
+        jobs = [executor.submit(polygonize_tile, fname, window, thresholds)
+                for window in tiles]
+        for job in jobs:
+            for i, polygons in enumerate(job.result()):
+                parts[i].extend(wkb.loads(p) for p in polygons)
+
+    logging.info('dissolving polygons')
+    # convert from pixel to map coordinates
+    matrix = [transform.a, transform.b, transform.d, transform.e,
+              transform.c, transform.f]
+    geometries = []
+    for polygons in parts:
+        geom = affine_transform(unary_union(polygons), matrix)
+        if simplify > 0:
+            geom = geom.simplify(simplify, preserve_topology=True)
+        geometries.append(geom)
+
+    return geopandas.GeoDataFrame({'hours': bands}, geometry=geometries,
+                                  crs=crs)
+
+
+def main(args=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if args is None:
+        args = parse_args('isochrones')
+
+    cfg = CpasConfig()
+    cfg.read(args.config)
+
+    # the travel times are on the grid of the landcover
+    with rasterio.open(cfg.landcover) as ds:
+        crs = ds.crs
+    isochrones = compute_isochrones(cfg.cost_path, cfg.isochrone_bands,
+                                    tile_size=cfg.isochrone_tile_size,
+                                    simplify=cfg.isochrone_simplify,
+                                    nprocs=cfg.nprocs, crs=crs)
+
+    output = args.output if args.output is not None else cfg.isochrones
+    logging.info(f'writing {output}')
+    isochrones.to_file(output, driver='GPKG', layer='isochrones')
+
+
+if __name__ == '__main__':
+    main()
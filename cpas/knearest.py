@@ -0,0 +1,219 @@
+# This file is part of cpas.
+#
+# cpas is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cpas is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cpas.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2020 cpas team
+
+# The search is compiled with numba. The labels are stored in numpy arrays
+# of shape (k, rows, columns) holding their float64 costs and int32
+# sources, plus a byte per cell counting the settled labels.
+
+import numpy
+from numba import njit
+
+# the steps to the 8 neighbouring cells: row offset, column offset, length
+STEPS = numpy.array([(dj, di, numpy.hypot(dj, di))
+                     for dj in (-1, 0, 1) for di in (-1, 0, 1)
+                     if dj != 0 or di != 0])
+
+
+@njit(cache=True, inline='always')
+def _cost(cs, j, i):
+    """cost of cell (j, i), -1 if it lies outside the grid or is
+    impassable"""
+    if j < 0 or j >= cs.shape[0] or i < 0 or i >= cs.shape[1]:
+        return -1.
+    c = cs[j, i]
+    if c >= 0 and c < numpy.inf:
+        return c
+    return -1.
+
+
+@njit(cache=True, inline='always')
+def _find(sources, j, i, source):
+    """index of the label of source at cell (j, i), -1 if there is none"""
+    for m in range(sources.shape[0]):
+        if sources[m, j, i] == source:
+            return m
+    return -1
+
+
+@njit(cache=True, inline='always')
+def _improve(costs, sources, count, j, i, cost, source):
+    """update the tentative labels of cell (j, i) with a new cost of
+    reaching source, return whether the cost was stored"""
+    k = costs.shape[0]
+    n = numpy.int64(count[j, i])
+    if n == k:
+        return False
+    # the worst tentative label is replaced, unused labels cost inf
+    worst = n
+    for m in range(k):
+        if sources[m, j, i] == source:
+            if m < n or costs[m, j, i] <= cost:
+                return False
+            costs[m, j, i] = cost
+            return True
+        if m > n and costs[m, j, i] > costs[worst, j, i]:
+            worst = m
+    if costs[worst, j, i] <= cost:
+        return False
+    costs[worst, j, i] = cost
+    sources[worst, j, i] = source
+    return True
+
+
+@njit(cache=True)
+def _grow(heap, entries):
+    """double the size of the heap arrays"""
+    return (numpy.concatenate((heap, numpy.empty_like(heap))),
+            numpy.concatenate((entries, numpy.empty_like(entries))))
+
+
+@njit(cache=True, inline='always')
+def _push(heap, entries, size, cost, entry):
+    """push an entry onto the binary heap, its arrays must not be full"""
+    n = size
+    while n > 0:
+        parent = (n - 1) >> 1
+        if heap[parent] <= cost:
+            break
+        heap[n] = heap[parent]
+        entries[n] = entries[parent]
+        n = parent
+    heap[n] = cost
+    entries[n] = entry
+
+
+@njit(cache=True, inline='always')
+def _pop(heap, entries, size):
+    """remove the last entry of the binary heap and sift it down from the
+    top, the top entry must have been read before"""
+    cost = heap[size]
+    entry = entries[size]
+    n = 0
+    while True:
+        child = 2 * n + 1
+        if child >= size:
+            break
+        if child + 1 < size and heap[child + 1] < heap[child]:
+            child += 1
+        if cost <= heap[child]:
+            break
+        heap[n] = heap[child]
+        entries[n] = entries[child]
+        n = child
+    heap[n] = cost
+    entries[n] = entry
+
+
+@njit(cache=True)
+def _search(cs, rows, cols, costs, sources, steps):
+    """run the multi-label Dijkstra search filling costs and sources
+
+    The first count labels of a cell are settled in order of increasing
+    cost, the remaining ones hold the k best tentative costs of reaching
+    sources not settled yet. A source is only pushed onto the heap when it
+    improves these, and entries whose label has since been improved or
+    replaced are skipped when popped.
+    """
+    k, height, width = costs.shape
+    count = numpy.zeros((height, width), dtype=numpy.uint8)
+
+    # the heap holds the tentative costs and the flat cell indices times
+    # the number of sources plus the sources
+    nsources = len(rows)
+    capacity = max(1024, nsources)
+    heap = numpy.empty(capacity)
+    entries = numpy.empty(capacity, dtype=numpy.int64)
+    size = 0
+    for s in range(nsources):
+        if _improve(costs, sources, count, rows[s], cols[s], 0., s):
+            _push(heap, entries, size, 0.,
+                  (rows[s] * width + cols[s]) * nsources + s)
+            size += 1
+
+    while size > 0:
+        cost = heap[0]
+        cell = entries[0] // nsources
+        source = entries[0] - cell * nsources
+        size -= 1
+        _pop(heap, entries, size)
+
+        j = cell // width
+        i = cell - j * width
+        n = count[j, i]
+        m = _find(sources, j, i, source)
+        if m < n or costs[m, j, i] != cost:
+            continue
+        # settle the label by moving it behind the settled ones
+        costs[m, j, i] = costs[n, j, i]
+        sources[m, j, i] = sources[n, j, i]
+        costs[n, j, i] = cost
+        sources[n, j, i] = source
+        count[j, i] = n + 1
+
+        c = _cost(cs, j, i)
+        for s in range(steps.shape[0]):
+            jo = j + numpy.int64(steps[s, 0])
+            io = i + numpy.int64(steps[s, 1])
+            co = _cost(cs, jo, io)
+            if co < 0:
+                continue
+            other = cost + 0.5 * (c + co) * steps[s, 2]
+            if _improve(costs, sources, count, jo, io, other, source):
+                if size == len(heap):
+                    heap, entries = _grow(heap, entries)
+                _push(heap, entries, size, other,
+                      (jo * width + io) * nsources + source)
+                size += 1
+
+
+def k_nearest_costs(cs, starts, k=2, out=None):
+    """compute the costs of reaching the k nearest sources from each cell
+
+    A single Dijkstra search is run in which each cell can be settled up
+    to k times, once for each of its k nearest sources. The cost of a step
+    between neighbouring cells is computed as by skimage's MCP_Geometric,
+    ie the mean of the costs of both cells times the length of the step.
+
+    Parameters
+    ----------
+    cs: 2D array containing the costsurface, negative or non-finite
+        values mark impassable cells
+    starts: list of (row, column) tuples of the source cells, each entry
+            is treated as a distinct source
+    k: number of nearest sources
+    out: array of shape (k, rows, columns) the costs are copied to, eg
+         to store them as float32. By default the float64 costs of the
+         search are returned
+
+    Returns
+    -------
+    array of shape (k, rows, columns) containing the costs of reaching the
+    nearest, second nearest, ... source, inf where fewer sources can be
+    reached
+    """
+
+    height, width = cs.shape
+    costs = numpy.full((k, height, width), numpy.inf)
+    if len(starts) > 0:
+        rows, cols = numpy.array(starts, dtype=numpy.int64).reshape(-1, 2).T
+        sources = numpy.full((k, height, width), -1, dtype=numpy.int32)
+        _search(cs, rows, cols, costs, sources, STEPS)
+        del sources
+    if out is None:
+        return costs
+    out[:] = costs
+    return out
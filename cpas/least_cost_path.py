@@ -21,28 +21,134 @@
 
 # Import packages
 import logging
-import sys
 import rioxarray
 import xarray
 import numpy
+import rasterio
+from rasterio import windows
 from skimage import graph
-import geopandas
 import random
+from .budget import MemoryBudget
+from .cells import cell_centres, nearest_cells
+from .checkpoint import Checkpoint, run_key
+from .cli import parse_args
 from .config import CpasConfig
+from .multires import refine_region, upsample
+from .vector import read_vector
 
 
-def service_area(cs, startCells):
-    """create a grid of access to services"""
+def bands_like(cs, nbands, values=None):
+    """create a grid with several bands on the grid of cs
 
-    # From the cost-surface create a 'landscape graph' object which can then be
-    # analysed using least-cost modelling
-    lg = graph.MCP_Geometric(cs.values, sampling=None)
+    Parameters
+    ----------
+    cs: grid whose coordinates and attributes are used
+    nbands: number of bands
+    values: array of shape (nbands, rows, columns) holding the values of
+            the grid, by default a float32 array of zeros is allocated
+    """
+
+    if values is None:
+        values = numpy.zeros((nbands,) + cs.shape[1:], dtype=numpy.float32)
+    coords = dict(cs.isel(band=0, drop=True).coords)
+    coords['band'] = numpy.arange(1, nbands + 1)
+    bands = xarray.DataArray(values, dims=cs.dims, coords=coords,
+                             attrs=cs.attrs)
+    bands.encoding = dict(cs.encoding)
+    return bands
+
+
+def lean_service_area(cs, startCells, traceback=False):
+    """create a grid of access to services using as little memory as possible
+
+    The graph is constructed on the 2D grid which needs less memory than
+    the (band, y, x) grid. The costs are stored as float32.
+
+    Parameters
+    ----------
+    cs: costsurface
+    startCells: list of indices of start cells
+    traceback: whether the traceback is needed
+
+    Returns
+    -------
+    the costs and the traceback using the offsets of the (band, y, x) grid,
+    None if it is not needed
+    """
+
+    lg = graph.MCP_Geometric(cs.values[0], sampling=None)
+    costs, tb = lg.find_costs(starts=[(j, i) for b, j, i in startCells])
+    offsets = numpy.asarray(lg.offsets)
+    del lg
 
+    # copy the costs into the float32 result
     lcd = xarray.zeros_like(cs, dtype=numpy.float32)
+    lcd.values[0] = costs
+    del costs
+    if not traceback:
+        return lcd, None
+
+    # map the steps of the 2D graph to those of the (band, y, x) graph
+    offsets3 = graph.MCP_Geometric(numpy.ones((1, 1, 1))).offsets
+    offsets3 = [tuple(o) for o in numpy.asarray(offsets3)]
+    steps = numpy.array([offsets3.index((0, dj, di)) for dj, di in offsets],
+                        dtype=tb.dtype)
+    tb = numpy.where(tb >= 0, steps[numpy.maximum(tb, 0)], tb)
+    return lcd, tb[numpy.newaxis]
+
+
+def service_area(cs, startCells, traceback=None, k_nearest=1,
+                 lean_memory=False):
+    """create a grid of access to services
+
+    Parameters
+    ----------
+    cs: costsurface
+    startCells: list of indices of start cells
+    traceback: when set store the traceback in this .npy file. The
+               traceback holds for each cell the index into the offsets of
+               the MCP graph of the step taken to reach the cell, -1 for
+               start cells and -2 for cells that cannot be reached
+    k_nearest: number of nearest services. When larger than 1 the costs
+               of reaching each of the k nearest services are stored in
+               separate bands
+    lean_memory: store the costs as float32 and free intermediate arrays
+                 as soon as possible
+    """
 
-    # Calculate the least-cost distance from the start cell to all other cells
-    # [0] is returning the cumulative costs rather than the traceback
-    lcd.values = lg.find_costs(starts=startCells)[0]
+    if k_nearest > 1:
+        # numba is only loaded when the k nearest services are needed
+        from .knearest import k_nearest_costs
+        starts = [(j, i) for b, j, i in startCells]
+        if lean_memory:
+            # the search keeps its float64 costs, only the result is
+            # copied into the float32 grid
+            lcd = bands_like(cs, k_nearest)
+            k_nearest_costs(cs.values[0], starts, k=k_nearest, out=lcd.values)
+            return lcd
+        costs = k_nearest_costs(cs.values[0], starts, k=k_nearest)
+        return bands_like(cs, k_nearest, values=costs)
+
+    if lean_memory:
+        lcd, tb = lean_service_area(cs, startCells,
+                                    traceback=traceback is not None)
+    else:
+        # From the cost-surface create a 'landscape graph' object which can
+        # then be analysed using least-cost modelling
+        lg = graph.MCP_Geometric(cs.values, sampling=None)
+
+        lcd = xarray.zeros_like(cs, dtype=numpy.float32)
+
+        # Calculate the least-cost distance from the start cell to all other
+        # cells [0] is returning the cumulative costs, [1] the traceback
+        costs, tb = lg.find_costs(starts=startCells)
+        lcd.values = costs
+        del costs
+
+    if traceback is not None:
+        # there are at most 26 offsets so the traceback fits into a byte
+        logging.info(f'writing traceback {traceback}')
+        numpy.save(traceback, tb.astype(numpy.int8))
 
     return lcd
 
@@ -59,14 +165,13 @@ def find_location_cells(destinations, cs):
     start_cells = []
     status = []
 
-    # loop over all destination locations
-    longs = cs.get_index('x')
-    lats = cs.get_index('y')
-
-    for location in destinations['geometry']:
-        idx_i = longs.get_loc(location.x, method='nearest')
-        idx_j = lats.get_loc(location.y, method='nearest')
+    # find the cells nearest to all destination locations
+    cells_i, cells_j = nearest_cells(destinations['geometry'].x,
+                                     destinations['geometry'].y,
+                                     cs.get_index('x'), cs.get_index('y'))
 
+    # loop over all destination locations
+    for idx_i, idx_j in zip(cells_i, cells_j):
         if cs[0, idx_j, idx_i].isnull():
             # if the cell is not valid check neighbouring cells
             alternatives = []
@@ -87,7 +192,39 @@ def find_location_cells(destinations, cs):
     return start_cells, status
 
 
-def compute_cost_path(csname, dname, invalid_loc, tag='Facility_n'):
+def read_cost_surface(csname):
+    """read a costsurface without making intermediate copies
+
+    Parameters
+    ----------
+    csname: name of costsurface file
+
+    Returns
+    -------
+    an xarray of shape (1, rows, columns) containing the costs as float64,
+    NaNs mark cells without data
+    """
+
+    with rasterio.open(csname) as ds:
+        data = numpy.empty((1, ds.height, ds.width), dtype=numpy.float64)
+        ds.read(1, out=data[0])
+        if ds.nodata is not None and not numpy.isnan(ds.nodata):
+            data[data == ds.nodata] = numpy.nan
+        transform = ds.transform
+        crs = ds.crs
+
+    x, y = cell_centres(transform, data.shape[2], data.shape[1])
+    cs = xarray.DataArray(data, dims=('band', 'y', 'x'),
+                          coords={'band': [1], 'y': y, 'x': x})
+    # modify in place, the default is to copy the data
+    if crs is not None:
+        cs.rio.write_crs(crs, inplace=True)
+    cs.rio.write_transform(transform, inplace=True)
+    return cs
+
+
+def compute_cost_path(csname, dname, invalid_loc, tag='Facility_n',
+                      traceback=None, k_nearest=1, lean_memory=False):
     """compute cost paths
 
     Parameters
@@ -96,16 +233,72 @@ def compute_cost_path(csname, dname, invalid_loc, tag='Facility_n'):
     dname: name of file containing destination locations
     invalid_loc: name of file for storing invalid locations
     tag: name of tag that contains the location name
+    traceback: name of .npy file for storing the traceback
+    k_nearest: number of nearest services
+    lean_memory: avoid copies of the grids and store the costs as float32
     """
 
     # import both cost surfaces
     # cost surface
     logging.info('load cost surface')
-    costsurface = rioxarray.open_rasterio(csname, masked=True)
+    if lean_memory:
+        costsurface = read_cost_surface(csname)
+    else:
+        costsurface = rioxarray.open_rasterio(csname, masked=True)
+
+    return surface_cost_path(costsurface, dname, invalid_loc, tag=tag,
+                             traceback=traceback, k_nearest=k_nearest,
+                             lean_memory=lean_memory)
+
+
+def write_invalid_locations(fname, destinations, tag, append=False):
+    """write the destinations that could not be placed on the costsurface
+
+    Parameters
+    ----------
+    fname: name of output file
+    destinations: data frame of destinations with a status column
+    tag: name of tag that contains the location name
+    append: add the locations to those already in the file, skipping
+            locations listed before
+    """
+
+    lines = []
+    for row in destinations[(destinations['status'] == 'i')].itertuples():
+        line = f'{row.Long},{row.Lat}'
+        if hasattr(row, tag):
+            line += ',"{}"'.format(getattr(row, tag))
+        lines.append(line + '\n')
+    if append:
+        with open(fname) as listed:
+            known = set(listed)
+        lines = [line for line in lines if line not in known]
+    with open(fname, 'a' if append else 'w') as invalid_out:
+        invalid_out.writelines(lines)
+
+
+def surface_cost_path(costsurface, dname, invalid_loc, tag='Facility_n',
+                      traceback=None, k_nearest=1, lean_memory=False,
+                      append_invalid=False):
+    """compute cost paths on a costsurface
+
+    Parameters
+    ----------
+    costsurface: costsurface, NaNs mark impassable cells
+    dname: name of file containing destination locations
+    invalid_loc: name of file for storing invalid locations
+    tag: name of tag that contains the location name
+    traceback: name of .npy file for storing the traceback
+    k_nearest: number of nearest services
+    lean_memory: modify the costsurface in place and store the costs as
+                 float32
+    append_invalid: add the invalid locations to those already stored in
+                    invalid_loc
+    """
 
     # import destination locations
-    destinations = geopandas.read_file(
-        dname,
+    destinations = read_vector(
+        dname, columns=[tag, 'Long', 'Lat'],
         bbox=costsurface.rio.bounds())
 
     # select destination locations that are valid to use with cost surface
@@ -119,49 +312,239 @@ def compute_cost_path(csname, dname, invalid_loc, tag='Facility_n'):
         print(f"moved {count['m']} locations")
     if 'i' in count:
         print(f"found {count['i']} invalid locations")
-    with open(invalid_loc, 'w') as invalid_out:
-        for row in destinations[(destinations['status'] == 'i')].itertuples():
-            invalid_out.write(f'{row.Long},{row.Lat}')
-            if hasattr(row, tag):
-                invalid_out.write(',"{}"'.format(getattr(row, tag)))
-            invalid_out.write('\n')
+    write_invalid_locations(invalid_loc, destinations, tag,
+                            append=append_invalid)
 
     # find costs algorithm does not deal with np.NaN so change these
     # to -9999 in cost surface any negative values are ignored
-    costsurface = costsurface.fillna(-9999)
+    if lean_memory:
+        numpy.copyto(costsurface.values, -9999,
+                     where=numpy.isnan(costsurface.values))
+    else:
+        costsurface = costsurface.fillna(-9999)
     # cs.data = np.where(cs.data != cs.data, -9999, cs.data)
 
     # calculate the costs for each square in the grid
     logging.info('calculating costs')
-    costs = service_area(costsurface, start_cells)
+    costs = service_area(costsurface, start_cells, traceback=traceback,
+                         k_nearest=k_nearest, lean_memory=lean_memory)
 
-    costs = xarray.where(numpy.isfinite(costs), costs, numpy.nan)
+    if lean_memory:
+        costs.values[~numpy.isfinite(costs.values)] = numpy.nan
+    else:
+        # unlike xarray.where, the method keeps the CRS of the costs
+        costs = costs.where(numpy.isfinite(costs))
 
     return costs
 
 
-def main():
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+def multires_cost_path(csname, coarse_name, dname, invalid_loc,
+                       tag='Facility_n', k_nearest=1, factor=1,
+                       refine_time=1., budget=None):
+    """compute cost paths on a coarse grid and refine them near services
 
-    # read configuration
-    cfg = CpasConfig()
-    cfg.read(sys.argv[1])
+    The costs are first computed on the coarse grid. They are then
+    recomputed at the native resolution for the region that can be reached
+    within refine_time on the coarse grid. The coarse costs are used
+    elsewhere, including the cells of the region which can only be reached
+    by a detour leaving it.
+
+    Parameters
+    ----------
+    csname: name of input costsurface file
+    coarse_name: name of coarsened costsurface file
+    dname: name of file containing destination locations
+    invalid_loc: name of file for storing invalid locations
+    tag: name of tag that contains the location name
+    k_nearest: number of nearest services
+    factor: number of native cells along each side of a coarse cell
+    refine_time: travel time in hours up to which costs are refined
+    budget: memory budget checked before refining the costs
+    """
+
+    logging.info('calculating coarse costs')
+    coarse = compute_cost_path(coarse_name, dname, invalid_loc, tag=tag,
+                               k_nearest=k_nearest)
+
+    logging.info('load cost surface')
+    costsurface = rioxarray.open_rasterio(csname, masked=True).load()
+    height, width = costsurface.shape[1:]
+    # the costs are kept as float32 like those of the lean memory mode
+    costs = bands_like(costsurface, k_nearest,
+                       values=upsample(coarse.values.astype(numpy.float32),
+                                       factor, height, width))
+
+    # the coarse costs of the k-th nearest service bound the region
+    region = refine_region(coarse.values[-1], refine_time * 3600)
+    if region is not None:
+        rows, cols = numpy.nonzero(region)
+        r0, r1 = rows.min() * factor, min((rows.max() + 1) * factor, height)
+        c0, c1 = cols.min() * factor, min((cols.max() + 1) * factor, width)
+        inside = region[numpy.arange(r0, r1)[:, None] // factor,
+                        numpy.arange(c0, c1)[None, :] // factor]
+        if budget is not None:
+            budget.plan_refine(inside.size, k_nearest=k_nearest,
+                               coarsen=factor)
+        logging.info(f'refining {inside.sum()} of {height * width} cells')
+        window = costsurface[:, r0:r1, c0:c1].where(inside)
+        # the locations invalid on the fine grid are added to those of
+        # the coarse grid
+        fine = surface_cost_path(window, dname, invalid_loc, tag=tag,
+                                 k_nearest=k_nearest, append_invalid=True)
+        costs.values[:, r0:r1, c0:c1] = numpy.where(
+            inside & numpy.isfinite(fine.values), fine.values,
+            costs.values[:, r0:r1, c0:c1])
+
+    # cells that are not valid at the native resolution
+    costs.values[:, numpy.isnan(costsurface.values[0])] = numpy.nan
+    return costs
+
+
+def checkpointed_cost_path(ckpt, stage, csname, dname, invalid_loc,
+                           tag='Facility_n', traceback=None, k_nearest=1,
+                           coarse_name=None, factor=1, refine_time=1.,
+                           lean_memory=False, budget=None):
+    """compute cost paths unless they are available from a checkpoint
+
+    Parameters
+    ----------
+    ckpt: checkpoint recording completed stages
+    stage: name of stage
+    csname: name of input costsurface file
+    dname: name of file containing destination locations
+    invalid_loc: name of file for storing invalid locations
+    tag: name of tag that contains the location name
+    traceback: name of .npy file for storing the traceback
+    k_nearest: number of nearest services
+    coarse_name: when set, name of coarsened costsurface file used for
+                 computing the costs at multiple resolutions
+    factor: number of native cells along each side of a coarse cell
+    refine_time: travel time in hours up to which costs are refined
+    lean_memory: avoid copies of the grids and store the costs as float32
+    budget: memory budget checked before refining the costs
+    """
+
+    if ckpt.done(stage):
+        logging.info('loading costs')
+        return rioxarray.open_rasterio(ckpt.path(stage)).load()
+
+    if coarse_name is not None:
+        costs = multires_cost_path(csname, coarse_name, dname, invalid_loc,
+                                   tag=tag, k_nearest=k_nearest,
+                                   factor=factor, refine_time=refine_time,
+                                   budget=budget)
+    else:
+        costs = compute_cost_path(csname, dname, invalid_loc, tag=tag,
+                                  traceback=traceback, k_nearest=k_nearest,
+                                  lean_memory=lean_memory)
+    ckpt.save(stage, costs)
+    return costs
+
+
+def merge_to_raster(fname, costs, out_name, block_rows=256):
+    """fill the gaps of stored costs and write them block by block
+
+    Parameters
+    ----------
+    fname: name of raster containing the costs
+    costs: xarray containing the costs used where the stored costs are
+           missing
+    out_name: name of output raster
+    block_rows: number of rows processed at a time
+    """
+
+    with rasterio.open(fname) as src:
+        profile = src.profile
+        # a tiled output allows efficient access to parts of the grid
+        profile.update(driver='GTiff', dtype='float32', tiled=True,
+                       blockxsize=256, blockysize=256)
+        with rasterio.open(out_name, 'w', **profile) as dst:
+            for row in range(0, src.height, block_rows):
+                window = windows.Window(0, row, src.width,
+                                        min(block_rows, src.height - row))
+                data = src.read(window=window, out_dtype=numpy.float32)
+                other = costs.values[:, row:row + window.height, :]
+                dst.write(numpy.where(numpy.isnan(data), other, data),
+                          window=window)
+
+
+def run(cfg, resume=False):
+    """compute the access to services
+
+    Parameters
+    ----------
+    cfg: cpas configuration
+    resume: whether to resume from the last completed stage
+    """
+
+    if cfg.keep_traceback and (cfg.k_nearest > 1 or cfg.coarsen > 1):
+        msg = 'the traceback can only be kept when k_nearest and coarsen ' \
+            'are 1'
+        raise RuntimeError(msg)
+    if cfg.lean_memory and cfg.coarsen > 1:
+        msg = 'the lean memory mode can only be used when coarsen is 1'
+        raise RuntimeError(msg)
+
+    # check the run fits into memory before doing any heavy work
+    budget = MemoryBudget(cfg.landcover, cfg.memory_limit)
+    budget.plan_path(k_nearest=cfg.k_nearest, lean_memory=cfg.lean_memory,
+                     coarsen=cfg.coarsen)
+
+    inputs = [cfg.costsurface, cfg.costsurface_water, cfg.destinations]
+    coarse = [None, None]
+    if cfg.coarsen > 1:
+        coarse = [cfg.costsurface_coarse, cfg.costsurface_water_coarse]
+        inputs += coarse
+    key = run_key(cfg, inputs)
+    ckpt = Checkpoint(cfg.checkpoints, 'path', key, resume=resume)
 
     logging.info('compute costs with water impassable')
-    cp = compute_cost_path(cfg.costsurface, cfg.destinations, cfg.invalid_loc,
-                           tag=cfg.destinations_cfg['tag'])
+    cp = checkpointed_cost_path(ckpt, 'water_impassable', cfg.costsurface,
+                                cfg.destinations, cfg.invalid_loc,
+                                tag=cfg.destinations_cfg['tag'],
+                                traceback=cfg.traceback,
+                                k_nearest=cfg.k_nearest,
+                                coarse_name=coarse[0], factor=cfg.coarsen,
+                                refine_time=cfg.refine_time,
+                                lean_memory=cfg.lean_memory, budget=budget)
+    if cfg.lean_memory:
+        # the costs are read back from the checkpoint when merging
+        del cp
     # repeat the above with water passable cost surface
     logging.info('compute costs with water passable')
-    cw = compute_cost_path(cfg.costsurface_water, cfg.destinations,
-                           cfg.invalid_loc_water,
-                           tag=cfg.destinations_cfg['tag'])
+    cw = checkpointed_cost_path(ckpt, 'water_passable', cfg.costsurface_water,
+                                cfg.destinations, cfg.invalid_loc_water,
+                                tag=cfg.destinations_cfg['tag'],
+                                traceback=cfg.traceback_water,
+                                k_nearest=cfg.k_nearest,
+                                coarse_name=coarse[1], factor=cfg.coarsen,
+                                refine_time=cfg.refine_time,
+                                lean_memory=cfg.lean_memory, budget=budget)
 
     # bring both access layers together for output
     logging.info('merge cost surface')
-    cp = xarray.where(cp.isnull(), cw, cp)
+    if cfg.lean_memory:
+        merge_to_raster(ckpt.path('water_impassable'), cw, cfg.cost_path)
+    else:
+        cp = cp.fillna(cw)
+
+        logging.info('write result')
+        # a tiled output allows efficient access to parts of the grid
+        cp.rio.to_raster(cfg.cost_path, tiled=True)
+    ckpt.finish()
+
+
+def main(args=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if args is None:
+        args = parse_args('path')
+
+    # read configuration
+    cfg = CpasConfig()
+    cfg.read(args.config)
 
-    logging.info('write result')
-    cp.rio.to_raster(cfg.cost_path)
+    run(cfg, resume=args.resume)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,127 @@
+# This file is part of cpas.
+#
+# cpas is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cpas is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cpas.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2020 cpas team
+
+import numpy
+import xarray
+from affine import Affine
+from .cells import cell_centres
+
+
+def coarsen_cost(cs, factor, roads=None):
+    """aggregate a cost surface to a coarser grid
+
+    Each coarse cell takes the mean cost of the valid fine cells it
+    contains, or the cost of its cheapest road cell if that is lower,
+    scaled to the size of the coarse cell. A road crossing a coarse cell
+    therefore keeps the coarse cell fast without the cheapest landcover
+    cell doing the same. Coarse cells containing no valid fine cell are
+    invalid. The coarse grid is aligned with the top left corner of the
+    fine grid, partial cells at the right and bottom edges are kept.
+
+    Parameters
+    ----------
+    cs: costsurface of shape (1, rows, columns)
+    factor: number of fine cells along each side of a coarse cell
+    roads: road speed surface of the same shape as cs, NaN where there
+           are no roads. By default no cell is treated as a road
+
+    Returns
+    -------
+    the coarse costsurface
+    """
+
+    height, width = cs.shape[1:]
+    cheight = -(-height // factor)
+    cwidth = -(-width // factor)
+    data = numpy.full((1, cheight, cwidth), numpy.nan)
+    for j in range(cheight):
+        fine = slice(j * factor, (j + 1) * factor)
+        block = _coarse_block(cs.values[0, fine, :], factor, cwidth)
+        valid = numpy.isfinite(block)
+        with numpy.errstate(invalid='ignore'):
+            data[0, j] = numpy.where(valid, block, 0).sum(axis=(0, 2)) / \
+                valid.sum(axis=(0, 2))
+        if roads is not None:
+            road = ~numpy.isnan(
+                _coarse_block(roads.values[0, fine, :], factor, cwidth))
+            # fmin ignores NaNs unless all values are NaN
+            data[0, j] = numpy.fmin(data[0, j], numpy.fmin.reduce(
+                numpy.where(road, block, numpy.nan), axis=(0, 2)))
+    data *= factor
+
+    transform = cs.rio.transform() * Affine.scale(factor)
+    x, y = cell_centres(transform, cwidth, cheight)
+    coarse = xarray.DataArray(data, dims=('band', 'y', 'x'),
+                              coords={'band': [1], 'y': y, 'x': x})
+    coarse = coarse.rio.write_crs(cs.rio.crs)
+    return coarse.rio.write_transform(transform)
+
+
+def _coarse_block(rows, factor, cwidth):
+    """arrange a block of fine rows as (factor, coarse columns, factor),
+    padding partial coarse cells with NaNs"""
+    block = numpy.full((factor, cwidth * factor), numpy.nan)
+    block[:rows.shape[0], :rows.shape[1]] = rows
+    return block.reshape(factor, cwidth, factor)
+
+
+def upsample(coarse, factor, height, width):
+    """repeat the values of a coarse grid onto the fine grid
+
+    Parameters
+    ----------
+    coarse: array of shape (bands, coarse rows, coarse columns)
+    factor: number of fine cells along each side of a coarse cell
+    height: number of rows of the fine grid
+    width: number of columns of the fine grid
+
+    Returns
+    -------
+    array of shape (bands, height, width)
+    """
+
+    rows = numpy.arange(height) // factor
+    cols = numpy.arange(width) // factor
+    return coarse[:, rows[:, None], cols[None, :]]
+
+
+def refine_region(coarse_time, threshold):
+    """find the coarse cells that are refined
+
+    Parameters
+    ----------
+    coarse_time: 2D array of coarse travel times
+    threshold: travel time up to which cells are refined
+
+    Returns
+    -------
+    boolean array marking the coarse cells to refine, None if there are
+    no such cells. The cells below the threshold are grown by one cell so
+    that paths reaching them are not cut off at the edge of the region.
+    """
+
+    with numpy.errstate(invalid='ignore'):
+        below = coarse_time <= threshold
+    if not below.any():
+        return None
+    padded = numpy.pad(below, 1)
+    region = numpy.zeros_like(below)
+    height, width = below.shape
+    for dj in range(3):
+        for di in range(3):
+            region |= padded[dj:dj + height, di:di + width]
+    return region
@@ -15,26 +15,17 @@
 #
 # Copyright (C) 2020 cpas team
 
+from .cli import parse_args
 from .config import CpasConfig
+from .vector import read_vector
 from matplotlib import pyplot
 import cartopy
-import geopandas
 import rioxarray
-import argparse
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('config', metavar='CFG',
-                        help="name of configuration file")
-    parser.add_argument('-s', '--speed-surface', metavar='GEOTIFF',
-                        help="load speed surface from GEOTIFF")
-    parser.add_argument('-l', '--show-destination-locations', default=False,
-                        action="store_true",
-                        help="show locations of destinations")
-    parser.add_argument('-o', '--output', metavar='FILE',
-                        help="save figure to FILE")
-    args = parser.parse_args()
+def main(args=None):
+    if args is None:
+        args = parse_args('plot')
 
     cfg = CpasConfig()
     cfg.read(args.config)
@@ -60,7 +51,7 @@ def main():
     ax.add_feature(cartopy.feature.BORDERS)
 
     if args.show_destination_locations:
-        destinations = geopandas.read_file(
+        destinations = read_vector(
             cfg.destinations,
             bbox=data.rio.bounds()).to_crs(epsg=cfg.epsg_code)
         destinations.plot(ax=ax, marker='o', markersize=5, color='black')
@@ -0,0 +1,324 @@
+# This file is part of cpas.
+#
+# cpas is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cpas is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cpas.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2020 cpas team
+
+import json
+import logging
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy
+import rasterio
+from rasterio import windows
+from rasterio.enums import Interleaving
+from .cells import cell_centres, nearest_cells
+from .cli import parse_args
+from .config import CpasConfig
+
+
+class TravelTimeQuery:
+    """look up values of a travel time raster
+
+    The raster is opened once. If it is stored uncompressed the file is
+    memory mapped and values are gathered directly from the tiles or
+    strips containing the requested cells. Otherwise the blocks containing
+    the requested cells are read and kept in a cache.
+
+    Parameters
+    ----------
+    fname: name of raster file
+    band: band to query
+    cache_blocks: maximum number of blocks kept in the cache
+    max_cells: maximum number of cells read by a bounding box query
+    """
+
+    def __init__(self, fname, band=1, cache_blocks=1024, max_cells=2**24):
+        self._ds = rasterio.open(fname)
+        self._band = band
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cache_blocks = cache_blocks
+        self.max_cells = max_cells
+
+        self.transform = self._ds.transform
+        self.height = self._ds.height
+        self.width = self._ds.width
+        self.dtype = numpy.dtype(self._ds.dtypes[band - 1])
+        self.nodata = self._ds.nodata
+        self.block_height, self.block_width = \
+            self._ds.block_shapes[band - 1]
+        self._longs, self._lats = cell_centres(self.transform, self.width,
+                                               self.height)
+
+        self._mmap = None
+        self._offsets = None
+        # memory mapping needs the values of a band stored contiguously
+        contiguous = self._ds.count == 1 or \
+            self._ds.interleaving == Interleaving.band
+        if self._ds.compression is None and contiguous:
+            self._map_blocks(fname)
+
+    def _map_blocks(self, fname):
+        """memory map the file and find the offsets of the blocks"""
+
+        nby = -(-self.height // self.block_height)
+        nbx = -(-self.width // self.block_width)
+        offsets = numpy.zeros((nby, nbx), dtype=numpy.int64)
+        for j in range(nby):
+            for i in range(nbx):
+                offset = self._ds.get_tag_item(f'BLOCK_OFFSET_{i}_{j}',
+                                               'TIFF', bidx=self._band)
+                if offset is None or int(offset) == 0:
+                    # block is not stored in file, fall back to reading
+                    return
+                offsets[j, i] = int(offset)
+
+        self._mmap = numpy.memmap(fname, dtype=numpy.uint8, mode='r')
+        byteorder = '<' if bytes(self._mmap[:2]) == b'II' else '>'
+        self._mdtype = self.dtype.newbyteorder(byteorder)
+        self._offsets = offsets
+        logging.info(f'memory mapped {fname}')
+
+    def close(self):
+        self._ds.close()
+
+    def cells(self, xs, ys):
+        """find the cells containing the locations
+
+        Parameters
+        ----------
+        xs: array of x coordinates
+        ys: array of y coordinates
+
+        Returns
+        -------
+        tuple of arrays of column and row indices and a mask of locations
+        inside the grid
+        """
+
+        xs = numpy.asarray(xs)
+        ys = numpy.asarray(ys)
+        left, bottom, right, top = self._ds.bounds
+        inside = (xs >= min(left, right)) & (xs <= max(left, right)) & \
+            (ys >= min(bottom, top)) & (ys <= max(bottom, top))
+        idx_i, idx_j = nearest_cells(xs, ys, self._longs, self._lats)
+        return idx_i, idx_j, inside
+
+    def _gather_mapped(self, idx_i, idx_j):
+        """gather values from the memory mapped file"""
+        bj, rj = numpy.divmod(idx_j, self.block_height)
+        bi, ri = numpy.divmod(idx_i, self.block_width)
+        start = self._offsets[bj, bi] + \
+            (rj * self.block_width + ri) * self.dtype.itemsize
+        byte = numpy.arange(self.dtype.itemsize)
+        raw = self._mmap[start[:, None] + byte[None, :]]
+        return raw.view(self._mdtype).ravel().astype(self.dtype)
+
+    def _block(self, bj, bi):
+        """read a block using the cache"""
+        key = (bj, bi)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        window = windows.Window(bi * self.block_width, bj * self.block_height,
+                                self.block_width, self.block_height)
+        window = window.intersection(windows.Window(0, 0, self.width,
+                                                    self.height))
+        data = self._ds.read(self._band, window=window)
+        self._cache[key] = data
+        if len(self._cache) > self._cache_blocks:
+            self._cache.popitem(last=False)
+        return data
+
+    def _gather_blocks(self, idx_i, idx_j):
+        """gather values by reading the blocks containing the cells"""
+        values = numpy.empty(len(idx_i), dtype=self.dtype)
+        bj, rj = numpy.divmod(idx_j, self.block_height)
+        bi, ri = numpy.divmod(idx_i, self.block_width)
+        blocks = bj * (self.width // self.block_width + 1) + bi
+        with self._lock:
+            for b in numpy.unique(blocks):
+                sel = blocks == b
+                data = self._block(bj[sel][0], bi[sel][0])
+                values[sel] = data[rj[sel], ri[sel]]
+        return values
+
+    def points(self, xs, ys):
+        """look up the values at many locations
+
+        Parameters
+        ----------
+        xs: array of x coordinates
+        ys: array of y coordinates
+
+        Returns
+        -------
+        array of values, NaN for locations outside the grid or without data
+        """
+
+        if len(xs) != len(ys):
+            msg = f'got {len(xs)} x but {len(ys)} y coordinates'
+            raise ValueError(msg)
+        idx_i, idx_j, inside = self.cells(xs, ys)
+        values = numpy.full(len(idx_i), numpy.nan)
+        if not inside.any():
+            return values
+
+        values[inside] = self.cell_values(idx_i[inside], idx_j[inside])
+        return values
+
+    def cell_values(self, idx_i, idx_j):
+        """look up the values of many cells
+
+        Parameters
+        ----------
+        idx_i: array of column indices
+        idx_j: array of row indices
+
+        Returns
+        -------
+        array of values, NaN for cells without data
+        """
+
+        if self._mmap is not None:
+            values = self._gather_mapped(idx_i, idx_j)
+        else:
+            values = self._gather_blocks(idx_i, idx_j)
+        values = values.astype(float)
+        if self.nodata is not None:
+            values[values == self.nodata] = numpy.nan
+        return values
+
+    def bbox(self, minx, miny, maxx, maxy):
+        """summarise the values within a bounding box
+
+        Parameters
+        ----------
+        minx, miny, maxx, maxy: bounding box
+
+        Returns
+        -------
+        dictionary containing the number of valid cells and the minimum,
+        mean and maximum value. The count is 0 if the bounding box lies
+        outside the grid
+        """
+
+        if minx >= maxx or miny >= maxy:
+            msg = 'empty bounding box'
+            raise ValueError(msg)
+        window = windows.from_bounds(minx, miny, maxx, maxy, self.transform)
+        window = window.round_offsets().round_lengths()
+        grid = windows.Window(0, 0, self.width, self.height)
+        if not windows.intersect(window, grid):
+            return {'count': 0}
+        window = window.intersection(grid)
+        if window.width * window.height > self.max_cells:
+            msg = f'bounding box covers {window.width * window.height} ' \
+                f'cells, at most {self.max_cells} are allowed'
+            raise ValueError(msg)
+        with self._lock:
+            data = self._ds.read(self._band, window=window).astype(float)
+        if self.nodata is not None:
+            data[data == self.nodata] = numpy.nan
+        valid = numpy.isfinite(data)
+        result = {'count': int(valid.sum())}
+        if result['count'] > 0:
+            result['min'] = float(data[valid].min())
+            result['mean'] = float(data[valid].mean())
+            result['max'] = float(data[valid].max())
+        return result
+
+
+def _to_json(values):
+    """convert array to list replacing NaNs with None"""
+    return [None if v != v else v for v in values.tolist()]
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """handle requests
+
+    POST /points with a JSON body {"x": [...], "y": [...]} returns
+    {"values": [...]}
+
+    GET /bbox?minx=..&miny=..&maxx=..&maxy=.. returns summary statistics
+    """
+
+    query = None
+
+    def _reply(self, code, result):
+        body = json.dumps(result).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/points':
+            self._reply(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            values = self.query.points(numpy.asarray(request['x'], float),
+                                       numpy.asarray(request['y'], float))
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': str(e)})
+            return
+        self._reply(200, {'values': _to_json(values)})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/bbox':
+            self._reply(404, {'error': 'not found'})
+            return
+        try:
+            args = parse_qs(url.query)
+            result = self.query.bbox(*[float(args[k][0]) for k in
+                                       ['minx', 'miny', 'maxx', 'maxy']])
+        except (ValueError, KeyError) as e:
+            self._reply(400, {'error': str(e)})
+            return
+        self._reply(200, result)
+
+    def log_message(self, format, *args):
+        logging.info(format % args)
+
+
+def main(args=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if args is None:
+        args = parse_args('query')
+
+    cfg = CpasConfig()
+    cfg.read(args.config)
+
+    fname = args.file if args.file is not None else cfg.cost_path
+    QueryHandler.query = TravelTimeQuery(fname, max_cells=args.max_cells)
+
+    server = ThreadingHTTPServer((args.host, args.port), QueryHandler)
+    logging.info(f'serving {fname} on {args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
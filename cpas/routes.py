@@ -0,0 +1,213 @@
+# This file is part of cpas.
+#
+# cpas is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cpas is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cpas.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2020 cpas team
+
+import logging
+from pathlib import Path
+import numpy
+import geopandas
+import rasterio
+from shapely.geometry import LineString
+from skimage import graph
+from .cli import parse_args
+from .config import CpasConfig
+from .query import TravelTimeQuery
+from .vector import read_vector
+
+
+def mcp_offsets():
+    """the offsets of the steps between neighbouring cells of the MCP graph
+    used for the (band, y, x) cost surfaces"""
+    lg = graph.MCP_Geometric(numpy.ones((1, 1, 1)))
+    return numpy.asarray(lg.offsets, dtype=numpy.int32)
+
+
+def trace_routes(traceback, offsets, rows, cols):
+    """follow the traceback from many origins back to their destinations
+
+    All origins are traced at the same time, one step per iteration. Only
+    the cells of the routes still being traced are stored at each step.
+
+    Parameters
+    ----------
+    traceback: traceback array of shape (1, height, width)
+    offsets: array of offsets of the MCP graph
+    rows: array of row indices of the origins
+    cols: array of column indices of the origins
+
+    Returns
+    -------
+    array of shape (cells, 3) containing the cells visited by the routes,
+    one route after the other, an array of n + 1 indices of the first cell
+    of each route followed by the number of cells, and an array containing
+    the number of steps of each route, -1 for origins that cannot be
+    reached
+    """
+
+    pos = numpy.stack([numpy.zeros_like(rows), rows, cols],
+                      axis=1).astype(numpy.int32)
+    lengths = numpy.zeros(len(pos), dtype=int)
+    reached = traceback[tuple(pos.T)] != -2
+    lengths[~reached] = -1
+
+    history = [pos.copy()]
+    route = [numpy.arange(len(pos))]
+    active = numpy.nonzero(traceback[tuple(pos.T)] >= 0)[0]
+    while len(active) > 0:
+        step = traceback[tuple(pos[active].T)]
+        pos[active] -= offsets[step]
+        lengths[active] += 1
+        history.append(pos[active])
+        route.append(active)
+        active = active[traceback[tuple(pos[active].T)] >= 0]
+
+    # group the cells by route keeping the order of the steps
+    route = numpy.concatenate(route)
+    order = numpy.argsort(route, kind='stable')
+    starts = numpy.zeros(len(pos) + 1, dtype=int)
+    numpy.cumsum(numpy.bincount(route, minlength=len(pos)), out=starts[1:])
+    return numpy.concatenate(history)[order], starts, lengths
+
+
+def route_times(cells, starts, costs):
+    """compute the accumulated travel time along routes
+
+    The cost of a step is the mean of the costs of both cells times the
+    length of the step as computed by the MCP graph.
+
+    Parameters
+    ----------
+    cells: array of shape (cells, 3) of cells visited by the routes
+    starts: array of indices of the first cell of each route followed by
+            the number of cells
+    costs: travel time query of the cost surface
+
+    Returns
+    -------
+    array containing the accumulated time at each cell
+    """
+
+    c = costs.cell_values(cells[:, 2], cells[:, 1])
+    dist = numpy.sqrt((numpy.diff(cells, axis=0) ** 2).sum(axis=1))
+    step = 0.5 * (c[1:] + c[:-1]) * dist
+    times = numpy.zeros(len(cells))
+    for first, end in zip(starts[:-1], starts[1:]):
+        numpy.cumsum(step[first:end - 1], out=times[first + 1:end])
+    return times
+
+
+def _load_traceback(fname):
+    if fname is None or not Path(fname).is_file():
+        msg = f'no traceback {fname}, run the least cost path ' \
+            'computation with keep_traceback = True'
+        raise RuntimeError(msg)
+    return numpy.load(fname, mmap_mode='r')
+
+
+def extract_routes(cfg, origins, id_column=None):
+    """extract the routes from origins to their nearest destination
+
+    Origins are traced using the traceback of the water impassable cost
+    surface if they can be reached that way and the water passable one
+    otherwise.
+
+    Parameters
+    ----------
+    cfg: cpas configuration
+    origins: geopandas data frame containing the origin locations
+    id_column: name of column identifying the origins, by default the
+               index is used
+
+    Returns
+    -------
+    geopandas data frame containing a line for each origin that can be
+    reached. The z coordinate of the vertices is the time in seconds
+    accumulated since leaving the origin.
+    """
+
+    offsets = mcp_offsets()
+    ids = origins.index if id_column is None else origins[id_column]
+    ids = numpy.asarray(ids)
+
+    routes = []
+    todo = numpy.ones(len(origins), dtype=bool)
+    for tname, csname, water in [(cfg.traceback, cfg.costsurface, False),
+                                 (cfg.traceback_water, cfg.costsurface_water,
+                                  True)]:
+        traceback = _load_traceback(tname)
+        costs = TravelTimeQuery(csname)
+        if costs.height != traceback.shape[1] or \
+           costs.width != traceback.shape[2]:
+            msg = f'traceback {tname} does not match cost surface {csname}'
+            raise RuntimeError(msg)
+
+        idx_i, idx_j, inside = costs.cells(origins.geometry.x,
+                                           origins.geometry.y)
+        sel = numpy.nonzero(todo & inside)[0]
+        logging.info(f'tracing {len(sel)} routes using {tname}')
+        cells, starts, lengths = trace_routes(traceback, offsets,
+                                              idx_j[sel], idx_i[sel])
+        times = route_times(cells, starts, costs)
+        costs.close()
+
+        transform = costs.transform
+        for k in numpy.nonzero(lengths >= 0)[0]:
+            route = slice(starts[k], starts[k + 1])
+            x, y = transform * (cells[route, 2] + 0.5, cells[route, 1] + 0.5)
+            z = times[route]
+            if len(z) == 1:
+                # the origin is at a destination
+                x, y, z = [numpy.repeat(a, 2) for a in (x, y, z)]
+            routes.append((ids[sel[k]], z[-1], water,
+                           LineString(numpy.column_stack([x, y, z]))))
+        todo[sel[lengths >= 0]] = False
+
+    if todo.any():
+        logging.info(f'{todo.sum()} origins cannot be reached')
+
+    id_name = 'id' if id_column is None else id_column
+    return geopandas.GeoDataFrame(
+        routes, columns=[id_name, 'travel_time', 'water', 'geometry'],
+        crs=origins.crs)
+
+
+def main(args=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if args is None:
+        args = parse_args('routes')
+
+    cfg = CpasConfig()
+    cfg.read(args.config)
+    if not cfg.keep_traceback:
+        msg = f'keep_traceback is not set in {args.config}'
+        raise RuntimeError(msg)
+
+    with rasterio.open(cfg.costsurface) as ds:
+        crs = ds.crs
+    origins = read_vector(args.origins)
+    if origins.crs is not None and crs is not None:
+        origins = origins.to_crs(crs)
+
+    routes = extract_routes(cfg, origins, id_column=args.id)
+
+    output = args.output if args.output is not None else cfg.routes
+    logging.info(f'writing {len(routes)} routes to {output}')
+    routes.to_file(output, driver='GPKG', layer='routes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+# This file is part of cpas.
+#
+# cpas is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cpas is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cpas.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2020 cpas team
+
+import logging
+import shutil
+import tempfile
+from pathlib import Path
+import numpy
+import rasterio
+import xarray
+from rasterio import windows
+
+# attributes stored in the band metadata rather than as tags
+BAND_ATTRS = ['scale_factor', 'add_offset', '_FillValue']
+
+
+def write_raster(array, fname, block_rows=1024):
+    """write an xarray to a GeoTIFF a block of rows at a time
+
+    rioxarray's to_raster holds a copy of the whole array, which defeats
+    memory mapping it.
+
+    Parameters
+    ----------
+    array: a 3D (band, y, x) xarray
+    fname: name of output file
+    block_rows: number of rows written at a time
+    """
+
+    nbands, height, width = array.shape
+    tags = {k: v for k, v in array.attrs.items() if k not in BAND_ATTRS}
+    nodata = array.rio.encoded_nodata
+    if nodata is None:
+        nodata = array.rio.nodata
+    with rasterio.open(fname, 'w', driver='GTiff', height=height,
+                       width=width, count=nbands, dtype=array.dtype,
+                       nodata=nodata, crs=array.rio.crs,
+                       transform=array.rio.transform(recalc=True)) as dst:
+        dst.update_tags(**tags)
+        for row in range(0, height, block_rows):
+            window = windows.Window(0, row, width,
+                                    min(block_rows, height - row))
+            dst.write(array.values[:, row:row + window.height, :],
+                      window=window)
+
+
+class ScratchSpace:
+    """allocate intermediate arrays
+
+    When a scratch directory is given the arrays are backed by memory
+    mapped files in a temporary directory below it. The operating system
+    can then page the data out to disk so that grids larger than the
+    available memory can be processed. The temporary directory is removed
+    when leaving the context.
+
+    Parameters
+    ----------
+    directory: directory for the memory mapped files, when None arrays are
+               held in memory
+    block_rows: number of rows processed at a time by blocks()
+    """
+
+    def __init__(self, directory=None, block_rows=1024):
+        self._directory = directory
+        self._tmpdir = None
+        self._count = 0
+        self.block_rows = block_rows
+
+    def __enter__(self):
+        if self._directory is not None:
+            Path(self._directory).mkdir(parents=True, exist_ok=True)
+            self._tmpdir = Path(tempfile.mkdtemp(prefix='cpas-',
+                                                 dir=self._directory))
+            logging.info(f'using scratch space {self._tmpdir}')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+        return False
+
+    @property
+    def memory_mapped(self):
+        return self._tmpdir is not None
+
+    def zeros_like(self, other, dtype=numpy.float32):
+        """create an array of zeros with the same coordinates as other
+
+        Parameters
+        ----------
+        other: xarray providing shape, coordinates and attributes
+        dtype: data type of new array
+
+        Returns
+        -------
+        an xarray which is memory mapped if a scratch directory is used
+        """
+
+        if self._tmpdir is None:
+            # other may be read lazily, only its shape is used
+            data = numpy.zeros(other.shape, dtype=dtype)
+        else:
+            self._count += 1
+            fname = self._tmpdir / f'array{self._count:03d}.dat'
+            # a newly created memory mapped file is filled with zeros
+            data = numpy.memmap(fname, dtype=dtype, mode='w+',
+                                shape=other.shape)
+        return xarray.DataArray(data, coords=other.coords, dims=other.dims,
+                                attrs=other.attrs)
+
+    def blocks(self, array):
+        """iterate over blocks of rows
+
+        Parameters
+        ----------
+        array: a 3D (band, y, x) array
+
+        Returns
+        -------
+        generator of slices selecting blocks of rows
+        """
+
+        nrows = array.shape[-2]
+        for row in range(0, nrows, self.block_rows):
+            yield slice(row, min(row + self.block_rows, nrows))
+
+    def write_raster(self, array, fname):
+        """write an xarray to a GeoTIFF a block of rows at a time
+
+        Parameters
+        ----------
+        array: a 3D (band, y, x) xarray
+        fname: name of output file
+        """
+        write_raster(array, fname, block_rows=self.block_rows)
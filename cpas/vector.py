@@ -0,0 +1,139 @@
+# This file is part of cpas.
+#
+# cpas is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cpas is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cpas.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2020 cpas team
+
+# Vector layers are usually read with fiona or geopandas.read_file which
+# parse every feature including all its attributes. Large layers stored
+# in the columnar GeoParquet or Arrow IPC formats are instead read with
+# only the columns needed, and for GeoParquet files written with a bbox
+# covering column, only the row groups intersecting the area of interest.
+#
+# geopandas is only imported when reading so that inspecting the schema
+# of a layer is quick.
+
+import json
+from pathlib import Path
+
+# name of the attribute holding the road type of the road layer
+ROAD_TAG = 'tag'
+
+PARQUET = ['.parquet', '.geoparquet']
+ARROW = ['.arrow', '.feather', '.ipc']
+
+
+def is_columnar(fname):
+    """whether a vector layer is stored in a columnar format"""
+    return Path(fname).suffix.lower() in PARQUET + ARROW
+
+
+def _schema(fname):
+    """the arrow schema of a columnar file"""
+    if Path(fname).suffix.lower() in PARQUET:
+        import pyarrow.parquet
+        return pyarrow.parquet.read_schema(fname)
+    import pyarrow
+    import pyarrow.ipc
+    with pyarrow.memory_map(str(fname)) as source:
+        return pyarrow.ipc.open_file(source).schema
+
+
+def column_names(fname):
+    """names of the attribute columns of a vector layer
+
+    Only the schema is read.
+    """
+    if is_columnar(fname):
+        return _schema(fname).names
+    import fiona
+    with fiona.open(fname) as layer:
+        return list(layer.schema['properties'])
+
+
+def geometry_column(fname):
+    """name of the primary geometry column of a columnar file
+
+    The name is taken from the GeoParquet metadata, files without it are
+    assumed to use 'geometry'.
+    """
+    metadata = _schema(fname).metadata or {}
+    if b'geo' not in metadata:
+        return 'geometry'
+    return json.loads(metadata[b'geo']).get('primary_column', 'geometry')
+
+
+def read_columnar(fname, columns=None, bbox=None):
+    """read a GeoParquet or Arrow IPC file
+
+    Parameters
+    ----------
+    fname: name of file
+    columns: names of the attribute columns to read, columns not present
+             in the file are ignored. By default all columns are read
+    bbox: only read features intersecting the bounding box
+          (minx, miny, maxx, maxy)
+
+    Returns
+    -------
+    geopandas data frame. The name of the file is stored in
+    attrs['path'].
+    """
+
+    import geopandas
+
+    if columns is not None:
+        names = column_names(fname)
+        # the geometry column is always read
+        columns = [c for c in columns if c in names]
+        columns += [c for c in [geometry_column(fname)] if c in names]
+
+    if Path(fname).suffix.lower() in PARQUET:
+        try:
+            # skips the row groups outside the bounding box if the file
+            # contains a bbox covering column
+            data = geopandas.read_parquet(fname, columns=columns, bbox=bbox)
+        except (TypeError, ValueError):
+            data = geopandas.read_parquet(fname, columns=columns)
+    else:
+        data = geopandas.read_feather(fname, columns=columns)
+
+    if bbox is not None:
+        minx, miny, maxx, maxy = bbox
+        data = data.cx[minx:maxx, miny:maxy]
+    data.attrs['path'] = str(fname)
+    return data
+
+
+def read_vector(fname, columns=None, bbox=None):
+    """read a vector layer
+
+    Parameters
+    ----------
+    fname: name of file
+    columns: names of the attribute columns needed, only used for
+             selecting the columns read from columnar files
+    bbox: only read features intersecting the bounding box
+          (minx, miny, maxx, maxy)
+
+    Returns
+    -------
+    geopandas data frame
+    """
+
+    import geopandas
+
+    if is_columnar(fname):
+        return read_columnar(fname, columns=columns, bbox=bbox)
+    return geopandas.read_file(fname, bbox=bbox)
@@ -11,9 +11,15 @@ setup(name='cpas',
       packages=['cpas', 'cpas.costsurface'],
       entry_points={
           'console_scripts': [
+              'cpas = cpas.cli:main',
               'cpas-compute = cpas.compute:main',
               'cpas-path = cpas.least_cost_path:main',
               'cpas-plot = cpas.plot:main',
+              'cpas-batch = cpas.batch:main',
+              'cpas-query = cpas.query:main',
+              'cpas-isochrones = cpas.isochrones:main',
+              'cpas-routes = cpas.routes:main',
+              'cpas-diff = cpas.diff:main',
           ],
       },
       )
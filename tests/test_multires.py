@@ -0,0 +1,71 @@
+# This file is part of cpas.
+#
+# cpas is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cpas is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cpas.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2020 cpas team
+
+import numpy
+import geopandas
+import rasterio
+import rioxarray
+from affine import Affine
+from shapely.geometry import Point
+from cpas.least_cost_path import compute_cost_path, multires_cost_path
+from cpas.multires import coarsen_cost
+
+SIZE = 64
+FACTOR = 4
+
+
+def write_wall(tmp_path):
+    """write a cost surface with a wall that can only be passed at the
+    bottom of the grid and a destination just west of the wall"""
+
+    cs = numpy.ones((SIZE, SIZE))
+    cs[:SIZE - 8, 20] = numpy.nan
+    csname = str(tmp_path / 'cs.tif')
+    with rasterio.open(csname, 'w', driver='GTiff', height=SIZE, width=SIZE,
+                       count=1, dtype='float64', crs='EPSG:32636',
+                       transform=Affine(1, 0, 0, 0, -1, SIZE)) as ds:
+        ds.write(cs, 1)
+
+    coarse_name = str(tmp_path / 'cs_coarse.tif')
+    coarse = coarsen_cost(rioxarray.open_rasterio(csname, masked=True),
+                          FACTOR)
+    coarse.rio.to_raster(coarse_name)
+
+    dname = str(tmp_path / 'destinations.gpkg')
+    x, y = 16.5, SIZE - 10.5
+    geopandas.GeoDataFrame({'Facility_n': ['clinic'], 'Long': [x],
+                            'Lat': [y]}, geometry=[Point(x, y)],
+                           crs='EPSG:32636').to_file(dname)
+    return csname, coarse_name, dname
+
+
+def test_detour_outside_refined_region(tmp_path):
+    csname, coarse_name, dname = write_wall(tmp_path)
+    invalid_loc = str(tmp_path / 'invalid.csv')
+
+    native = compute_cost_path(csname, dname, invalid_loc).values[0]
+    multires = multires_cost_path(csname, coarse_name, dname, invalid_loc,
+                                  factor=FACTOR,
+                                  refine_time=30 / 3600).values[0]
+
+    # the cells east of the wall near the destination are refined but can
+    # only be reached through the gap below the refined region
+    assert numpy.isfinite(native[10, 24])
+    assert numpy.array_equal(numpy.isfinite(native),
+                             numpy.isfinite(multires))
+    # the refined cells west of the wall are exact
+    assert numpy.isclose(multires[10, 12], native[10, 12])